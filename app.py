@@ -1,17 +1,29 @@
-# --- Файл: app.py (Финальная версия v3, все включено) ---
+# --- Файл: app.py (Telegram-бот журнала сделок: webhook, Google Sheets, Bybit) ---
 
 import os
 import logging
 import datetime
+import functools
+import hashlib
+import hmac
+import pathlib
+import queue
+import random
+import re
+import threading
+import time
+import orjson  # Быстрый разбор JSON из webhook (прямо из bytes)
 import requests
 import telebot
 import gspread
 from flask import Flask, request
+from urllib3.util import Retry
 import pandas as pd  # Для манипуляций с данными
 from ta.trend import SMAIndicator, ADXIndicator  # Для расчетов SMA и ADX
 
 # Используем современную библиотеку google-auth
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
 # Используем библиотеку pybit для Bybit API v5
 from pybit.unified_trading import HTTP
@@ -35,6 +47,13 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TOKEN:
     logger.error("FATAL: TELEGRAM_BOT_TOKEN not set!")
 
+# secret_token из setWebhook: Telegram присылает его в заголовке каждого запроса
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Публичный адрес сервиса (https://...): если задан, webhook регистрируется при старте
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_ALLOWED_UPDATES = ["message"]  # Бот обрабатывает только сообщения
+
 WEBAPP_URL = os.getenv("WEBAPP_URL")
 if not WEBAPP_URL:
     logger.warning(
@@ -48,6 +67,7 @@ GLOSSARY_SHEET_NAME = os.getenv(
     "GLOSSARY_SHEET_NAME", "Глоссарий"
 )  # Имя листа глоссария
 SCREENER_SHEET_NAME = os.getenv("SCREENER_SHEET_NAME", "Скринер")
+SECRETS_DIR = "/etc/secrets"  # Secret Files на Render
 CREDENTIALS_PATH = "/etc/secrets/credentials.json"  # Путь к секретному файлу Render
 
 # --- Структура Таблицы Сделок (A-AD, 30 столбцов) ---
@@ -80,17 +100,82 @@ COL_IDX = {
     "not_worked": 25,
     "entry_reason": 26,
     "conclusions": 27,
-    "screenshot": 28,
-    "bybit_exec_id": 29,  # AC: Bybit Exec ID
-    "entry_order_id": 30,  # AD: Bybit Order ID
+    "bybit_exec_id": 28,  # AC: Bybit Exec ID
+    "entry_order_id": 29,  # AD: Bybit Order ID
 }
+
+
+def column_letter(col_idx):
+    """Буква столбца по индексу с 0 (0 -> "A", 29 -> "AD")."""
+    return gspread.utils.rowcol_to_a1(1, col_idx + 1)[:-1]
+
+
+# Буквы столбцов считаются один раз при старте, а не при каждой записи
+COL_LETTER = {name: column_letter(idx) for name, idx in COL_IDX.items()}
+
 # Ожидаемое количество колонок в основном листе
 EXPECTED_COLUMNS = 30
+# Дата входа, если Bybit не прислал время исполнения (столбец A не оставляем пустым)
+MISSING_ENTRY_DATE = "н/д"
 
 # --- Bybit ---
 BYBIT_ENV = os.getenv("BYBIT_ENV", "LIVE").upper()
 BYBIT_CATEGORY = os.getenv("BYBIT_CATEGORY", "linear")
 
+# --- Форматы команд (проверка и разбор за один проход) ---
+_ADD_RE = re.compile(
+    r"^/add(?:@\w+)?\s+(?P<asset>\S+)\s+(?P<dir>Лонг|Шорт)\s+(?P<entry>[\d.]+)"
+    r"\s+(?P<tp>[\d.]+)\s+(?P<sl>[\d.]+)\s+(?P<qty>[\d.]+)\s+(?P<oid>\S+)\s*$",
+    re.IGNORECASE,
+)
+_FETCH_RE = re.compile(r"^/fetch(?:@\w+)?\s+(?P<exec_id>\S+)\s*$")
+_CLOSE_RE = re.compile(r"^/close(?:@\w+)?\s+(?P<asset>\S+)\s+(?P<price>[\d.]+)\s*$")
+# Ответ на кнопку "Закрыть сделку": "<Пара> <Цена>", цена может быть с запятой
+_CLOSE_INPUT_RE = re.compile(r"^\s*(?P<asset>\S+)\s+(?P<price>[\d.,]+)\s*$")
+
+# --- Очередь записи в таблицу ---
+SHEET_WRITE_BATCH_DELAY = 0.2  # Окно (сек) для накопления записей в одну пачку
+SHEET_WRITE_MAX_BATCH = (
+    50  # Больше записей за раз не берем, остальное - следующей пачкой
+)
+SHEET_WRITE_RETRY_DELAY = 5  # Пауза перед повтором после ошибки записи
+SHEET_WRITE_MAX_ATTEMPTS = 3  # После стольких неудач запись отбрасывается
+# Повтор запросов к Google при 429/5xx: экспоненциальная пауза со случайной добавкой
+GOOGLE_RETRY_ATTEMPTS = 4
+GOOGLE_RETRY_BASE_DELAY = 0.5  # сек, удваивается с каждой попыткой
+GOOGLE_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Квоты Sheets API на пользователя: запросов чтения и записи в минуту
+SHEETS_READS_PER_MINUTE = int(os.getenv("SHEETS_READS_PER_MINUTE", "60"))
+SHEETS_WRITES_PER_MINUTE = int(os.getenv("SHEETS_WRITES_PER_MINUTE", "60"))
+# Токен Google живет час; обновляем его заранее в фоне, а не внутри запроса пользователя
+GOOGLE_TOKEN_REFRESH_INTERVAL = 50 * 60  # сек
+
+# Сколько обновлений Telegram обрабатывается параллельно (все обработчики ждут сеть)
+BOT_WORKER_THREADS = int(os.getenv("BOT_WORKER_THREADS", "8"))
+
+# Кэш исполнений полностью исполненных ордеров (они на бирже уже не меняются)
+ORDER_EXEC_CACHE_TTL = 3600  # сек
+ORDER_EXEC_CACHE_SIZE = 512  # ордеров
+
+# Лимиты Telegram на исходящие сообщения (с небольшим запасом)
+TG_GLOBAL_RATE = 28  # сообщений в секунду на весь бот
+TG_GROUP_RATE = 18  # сообщений в минуту в одну группу
+# Таймауты запросов к Telegram (у telebot по умолчанию 15/30 с): зависший ответ
+# не должен надолго занимать рабочий поток
+TG_CONNECT_TIMEOUT = 5  # сек
+TG_READ_TIMEOUT = 10  # сек
+
+# Keep-alive соединений на хост: по одному на рабочий поток бота + фоновая запись
+HTTP_POOL_SIZE = BOT_WORKER_THREADS + 2
+# Повтор чтений Google (GET) при 429/5xx; POST-записи не повторяются, чтобы не задвоить строки
+GOOGLE_READ_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=["GET"],
+    raise_on_status=False,
+)
+
 # === Глобальные переменные ===
 bot = None
 sheet = None  # Лист "Таблица сделок"
@@ -101,25 +186,205 @@ google_client = None
 app = None
 user_states = {}  # Для хранения состояния разговора (например, для глоссария)
 screener_sheet = None  # Лист для скринера
+sheet_write_queue = queue.Queue()  # Строки сделок, ожидающие записи в таблицу
+notify_queue = queue.Queue()  # Ответы пользователям из потока записи
+claimed_close_rows = set()  # Строки, закрытие которых стоит в очереди (поток записи)
+order_exec_cache = {}  # orderId -> (время истечения, список исполнений)
+order_exec_cache_lock = threading.Lock()
+http_session = requests.Session()  # Общая сессия для прочих HTTP-запросов (Apps Script)
 
 # === Инициализация Flask ===
 # Инициализируем Flask ДО попытки использования 'app'
 app = Flask(__name__)
 
+
 # === Инициализация Telegram бота ===
+class TokenBucket:
+    """Потокобезопасный token bucket: не больше rate событий за per секунд."""
+
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / per
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Блокирует вызывающий поток, пока не освободится токен."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.fill_rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+
+class RateLimitedTeleBot(telebot.TeleBot):
+    """TeleBot, который сам придерживает исходящие сообщения, чтобы не ловить 429.
+
+    reply_to тоже идет через send_message, поэтому лимит действует на оба вызова.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, 1)
+        self.chat_buckets = {}
+        self.chat_buckets_lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        # Поминутный лимит Telegram действует только для групп (id < 0)
+        if not isinstance(chat_id, int) or chat_id >= 0:
+            return None
+        with self.chat_buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(TG_GROUP_RATE, 60)
+            return bucket
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        chat_bucket = self._chat_bucket(chat_id)
+        if chat_bucket:
+            chat_bucket.acquire()
+        self.global_bucket.acquire()
+        return super().send_message(chat_id, text, *args, **kwargs)
+
+
+class LoggingExceptionHandler(telebot.ExceptionHandler):
+    """Пишет в лог ошибки обработчиков, упавших в пуле потоков telebot."""
+
+    def handle(self, exception):
+        logger.error("Unhandled error in bot handler: %s", exception, exc_info=True)
+        return True
+
+
 if TOKEN:
     try:
-        bot = telebot.TeleBot(TOKEN, threaded=False)
+        # Обработчики выполняются в пуле потоков telebot: webhook сразу отвечает 200,
+        # а медленные запросы к Google Sheets и Bybit у разных пользователей идут параллельно
+        bot = RateLimitedTeleBot(
+            TOKEN,
+            threaded=True,
+            num_threads=BOT_WORKER_THREADS,
+            exception_handler=LoggingExceptionHandler(),
+        )
         logger.info("Telegram bot initialized.")
     except Exception as e:
-        logger.error(f"Telegram init error: {e}", exc_info=True)
+        logger.error("Telegram init error: %s", e, exc_info=True)
         bot = None  # Убедимся, что bot=None при ошибке
 else:
     logger.error("TELEGRAM_BOT_TOKEN not set!")
     bot = None
 
 
+# === Квоты и повтор запросов к Google ===
+# Ждем локально, а не получаем 429 от Google и не тратим на него запрос
+sheets_read_bucket = TokenBucket(SHEETS_READS_PER_MINUTE, 60)
+sheets_write_bucket = TokenBucket(SHEETS_WRITES_PER_MINUTE, 60)
+
+
+def retry_after_seconds(error):
+    """Пауза из заголовка Retry-After ответа Google, если он есть."""
+    value = error.response.headers.get("Retry-After", "")
+    return float(value) if value.isdigit() else None
+
+
+def google_retry(idempotent=True):
+    """Декоратор для записей в Sheets: квота sheets_write_bucket и повтор при 429/5xx.
+
+    Пауза - Retry-After, если Google его прислал, иначе экспоненциальная с jitter.
+    Для неидемпотентных записей (append) повторяется только 429: при 5xx строка могла уже
+    записаться, и повтор ее задвоил бы.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(GOOGLE_RETRY_ATTEMPTS):
+                sheets_write_bucket.acquire()
+                try:
+                    return fn(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    status = e.response.status_code
+                    retryable = status == 429 or (
+                        idempotent and status in GOOGLE_RETRY_STATUSES
+                    )
+                    if not retryable or attempt == GOOGLE_RETRY_ATTEMPTS - 1:
+                        raise
+                    delay = retry_after_seconds(e)
+                    if delay is None:
+                        delay = GOOGLE_RETRY_BASE_DELAY * 2**attempt + random.uniform(
+                            0, GOOGLE_RETRY_BASE_DELAY
+                        )
+                    logger.warning(
+                        "%s: Google API %s, retry %s in %.1fs",
+                        fn.__name__,
+                        status,
+                        attempt + 1,
+                        delay,
+                    )
+                    time.sleep(delay)
+
+        return wrapper
+
+    return decorator
+
+
 # === Функции Инициализации Сервисов ===
+def mount_pooled_adapter(session, max_retries=0):
+    """Расширяет пул keep-alive соединений сессии requests под число рабочих потоков.
+
+    С пулом по умолчанию (10) лишние потоки открывали бы новое TLS-соединение на каждый запрос.
+    """
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=max_retries,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def ensure_webhook():
+    """Регистрирует webhook в Telegram, только если адрес или параметры отличаются от нужных.
+
+    Проверка через getWebhookInfo не дает каждому воркеру gunicorn дергать setWebhook.
+    getWebhookInfo не возвращает secret_token, поэтому при заданном WEBHOOK_SECRET
+    webhook регистрируется всегда: иначе после смены секрета Telegram слал бы старый,
+    и все обновления отсекались бы с 403.
+    """
+    url = f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/{TOKEN}"
+    try:
+        info = bot.get_webhook_info()
+        if (
+            not WEBHOOK_SECRET
+            and info.url == url
+            and info.max_connections == WEBHOOK_MAX_CONNECTIONS
+            and info.allowed_updates == WEBHOOK_ALLOWED_UPDATES
+        ):
+            logger.info("Telegram webhook is already up to date.")
+            return True
+        bot.set_webhook(
+            url=url,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+            secret_token=WEBHOOK_SECRET,
+        )
+        logger.info(
+            "Telegram webhook registered (max_connections=%s).",
+            WEBHOOK_MAX_CONNECTIONS,
+        )
+        return True
+    except Exception as e:
+        logger.error("Failed to register Telegram webhook: %s", e, exc_info=True)
+        return False
+
+
 def init_google_sheets():
     """Инициализирует подключение к Google Sheets и обоим листам."""
     global sheet, glossary_sheet, screener_sheet, google_creds, google_client
@@ -129,7 +394,7 @@ def init_google_sheets():
         return False
     # Используем CREDENTIALS_PATH определенный выше
     if not os.path.exists(CREDENTIALS_PATH):
-        logger.error(f"FATAL: Credentials file not found at {CREDENTIALS_PATH}!")
+        logger.error("FATAL: Credentials file not found at %s!", CREDENTIALS_PATH)
         return False
     try:
         scope = [
@@ -142,32 +407,38 @@ def init_google_sheets():
             CREDENTIALS_PATH, scopes=scope
         )
         google_client = gspread.authorize(google_creds)
+        mount_pooled_adapter(
+            google_client.http_client.session, max_retries=GOOGLE_READ_RETRY
+        )
         spreadsheet = google_client.open_by_key(SPREADSHEET_ID)
         # Инициализируем листы в отдельных try-except
         try:
             sheet = spreadsheet.worksheet(SHEET_NAME)
-            logger.info(f"Connected to Main Sheet: '{sheet.title}'")
+            logger.info("Connected to Main Sheet: '%s'", sheet.title)
             if sheet.col_count < EXPECTED_COLUMNS:
                 logger.warning(
-                    f"Main Sheet has {sheet.col_count} cols, expected {EXPECTED_COLUMNS}."
+                    "Main Sheet has %s cols, expected %s.",
+                    sheet.col_count,
+                    EXPECTED_COLUMNS,
                 )
         except gspread.exceptions.WorksheetNotFound:
-            logger.error(f"FATAL: Main Worksheet '{SHEET_NAME}' not found!")
+            logger.error("FATAL: Main Worksheet '%s' not found!", SHEET_NAME)
             sheet = None
         try:
             glossary_sheet = spreadsheet.worksheet(GLOSSARY_SHEET_NAME)
-            logger.info(f"Connected to Glossary Sheet: '{glossary_sheet.title}'")
+            logger.info("Connected to Glossary Sheet: '%s'", glossary_sheet.title)
         except gspread.exceptions.WorksheetNotFound:
             logger.error(
-                f"FATAL: Glossary Worksheet '{GLOSSARY_SHEET_NAME}' not found!"
+                "FATAL: Glossary Worksheet '%s' not found!", GLOSSARY_SHEET_NAME
             )
             glossary_sheet = None
         try:
             screener_sheet = spreadsheet.worksheet(SCREENER_SHEET_NAME)
-            logger.info(f"Подключено к листу скринера: '{screener_sheet.title}'")
+            logger.info("Подключено к листу скринера: '%s'", screener_sheet.title)
         except gspread.exceptions.WorksheetNotFound:
             logger.warning(
-                f"Лист скринера '{SCREENER_SHEET_NAME}' не найден. Он будет создан при первом использовании."
+                "Лист скринера '%s' не найден. Он будет создан при первом использовании.",
+                SCREENER_SHEET_NAME,
             )
             screener_sheet = (
                 None  # Устанавливаем в None, будет создан позже, если потребуется
@@ -181,66 +452,92 @@ def init_google_sheets():
         if hasattr(e, "response") and e.response.status_code == 401:
             logger.warning("Ошибка Google API 401. Требуется обновление?")
         else:
-            logger.error(f"ФАТАЛЬНАЯ ОШИБКА: Ошибка Google API: {e}", exc_info=True)
+            logger.error("ФАТАЛЬНАЯ ОШИБКА: Ошибка Google API: %s", e, exc_info=True)
         return False
     except Exception as e:
         logger.error(
-            f"ФАТАЛЬНАЯ ОШИБКА: Ошибка подключения к Google Sheets: {e}", exc_info=True
+            "ФАТАЛЬНАЯ ОШИБКА: Ошибка подключения к Google Sheets: %s", e, exc_info=True
         )
         return False
 
 
+class CachedSignatureHTTP(HTTP):
+    """HTTP-клиент pybit, который готовит HMAC-ключ один раз и копирует его для каждой подписи."""
+
+    def _auth(self, payload, recv_window, timestamp):
+        if self.rsa_authentication or self.api_key is None or self.api_secret is None:
+            return super()._auth(payload, recv_window, timestamp)
+        hmac_base = self.__dict__.get("_hmac_base")
+        if hmac_base is None:
+            hmac_base = hmac.new(self.api_secret.encode("utf-8"), None, hashlib.sha256)
+            self._hmac_base = hmac_base
+        signer = hmac_base.copy()  # Копия уже содержит подготовленные ipad/opad ключа
+        signer.update(
+            f"{timestamp}{self.api_key}{recv_window}{payload}".encode("utf-8")
+        )
+        return signer.hexdigest()
+
+
+def read_secret(name):
+    """Секрет из переменной окружения name, иначе из Secret File /etc/secrets/<name>. "" если нет."""
+    value = os.getenv(name)
+    if value:
+        return value.strip()
+    path = pathlib.Path(SECRETS_DIR, name)
+    return path.read_text().strip() if path.exists() else ""
+
+
 def init_bybit():
-    """Инициализирует подключение к Bybit, читая ключи из Secret Files."""
+    """Инициализирует подключение к Bybit; ключи - из переменных окружения или Secret Files."""
     global bybit_session
     env = os.getenv("BYBIT_ENV", "LIVE").upper()
-    logger.info(f"Attempting to connect to Bybit {env} environment...")
-    api_key = None
-    api_secret = None
-    testnet_flag = False
-    if env == "TESTNET":
-        key_path = "/etc/secrets/BYBIT_API_KEY_TESTNET"
-        secret_path = "/etc/secrets/BYBIT_API_SECRET_TESTNET"
-        testnet_flag = True
-    else:
+    logger.info("Attempting to connect to Bybit %s environment...", env)
+    testnet_flag = env == "TESTNET"
+    if not testnet_flag:
         env = "LIVE"
-        key_path = "/etc/secrets/BYBIT_API_KEY_LIVE"
-        secret_path = "/etc/secrets/BYBIT_API_SECRET_LIVE"
-        testnet_flag = False
-    if not os.path.exists(key_path):
-        logger.error(f"FATAL: Key file not found for {env} at {key_path}!")
-        return False
-    if not os.path.exists(secret_path):
-        logger.error(f"FATAL: Secret file not found for {env} at {secret_path}!")
-        return False
     try:
-        with open(key_path, "r") as f:
-            api_key = f.read().strip()
-        with open(secret_path, "r") as f:
-            api_secret = f.read().strip()
+        api_key = read_secret(f"BYBIT_API_KEY_{env}")
+        api_secret = read_secret(f"BYBIT_API_SECRET_{env}")
         if not api_key or not api_secret:
-            logger.error(f"FATAL: Key or Secret file for {env} is empty!")
+            logger.error(
+                "FATAL: Bybit key or secret for %s not found in env or %s!",
+                env,
+                SECRETS_DIR,
+            )
             return False
-        bybit_session = HTTP(
+        bybit_session = CachedSignatureHTTP(
             testnet=testnet_flag, api_key=api_key, api_secret=api_secret
         )
+        mount_pooled_adapter(bybit_session.client)
         # Проверка соединения (опционально) - делаем простой запрос
         logger.info("Checking Bybit API connection with get_instruments_info...")
         check_conn = bybit_session.get_instruments_info(
             category=BYBIT_CATEGORY, limit=1
         )
         if check_conn.get("retCode") != 0:
-            logger.error(f"Bybit API connection check failed for {env}: {check_conn}")
+            logger.error(
+                "Bybit API connection check failed for %s: %s", env, check_conn
+            )
             bybit_session = None  # Сбрасываем сессию при ошибке
             return False
-        logger.info(f"Successfully initialized Bybit API connection for {env}.")
+        logger.info("Successfully initialized Bybit API connection for %s.", env)
         return True
     except Exception as e:
-        logger.error(f"FATAL: Error connecting to Bybit {env} API: {e}", exc_info=True)
+        logger.error(
+            "FATAL: Error connecting to Bybit %s API: %s", env, e, exc_info=True
+        )
         return False
 
 
 # === Функции для Скринера ===
+@google_retry()
+def rewrite_screener_sheet(market_rows):
+    """Перезаписывает лист скринера целиком (clear + запись), поэтому повтор безопасен."""
+    screener_sheet.clear()
+    header = [["Pair", "SMA30", "SMA90", "ADX", "Vol", "Time"]]
+    screener_sheet.append_rows(header + market_rows, value_input_option="USER_ENTERED")
+
+
 def fetch_and_write_screener(bybit_session, spreadsheet):
     """
     Скачивает 4h-данные по топ-20 USDT-парам, считает SMA30, SMA90, ADX и записывает в лист Скринер.
@@ -254,21 +551,21 @@ def fetch_and_write_screener(bybit_session, spreadsheet):
             try:
                 screener_sheet = spreadsheet.worksheet(SCREENER_SHEET_NAME)
                 logger.info(
-                    f"Повторно подключено к листу скринера: '{screener_sheet.title}'"
+                    "Повторно подключено к листу скринера: '%s'", screener_sheet.title
                 )
             except gspread.exceptions.WorksheetNotFound:
                 logger.info(
-                    f"Лист скринера '{SCREENER_SHEET_NAME}' не найден, создаю его..."
+                    "Лист скринера '%s' не найден, создаю его...", SCREENER_SHEET_NAME
                 )
                 # Если листа нет — создаём. Убедитесь, что `google_client` (который `client` в connect_google_sheets) доступен.
                 # Или передавайте `google_client` как аргумент. Здесь я полагаю, что `spreadsheet` уже получен через `google_client`.
                 screener_sheet = spreadsheet.add_worksheet(
                     title=SCREENER_SHEET_NAME, rows="100", cols="10"
                 )
-                logger.info(f"Создан новый лист скринера: '{SCREENER_SHEET_NAME}'")
+                logger.info("Создан новый лист скринера: '%s'", SCREENER_SHEET_NAME)
         else:
             logger.info(
-                f"Использую существующий лист скринера: '{screener_sheet.title}'"
+                "Использую существующий лист скринера: '%s'", screener_sheet.title
             )
 
         if not screener_sheet:
@@ -301,7 +598,7 @@ def fetch_and_write_screener(bybit_session, spreadsheet):
 
         market_rows = []
         for symbol in top_pairs:
-            logger.debug(f"Получаю данные свечей для {symbol}...")
+            logger.debug("Получаю данные свечей для %s...", symbol)
             klines_response = bybit_session.get_kline(
                 symbol=symbol,
                 interval="240",
@@ -309,13 +606,15 @@ def fetch_and_write_screener(bybit_session, spreadsheet):
             )
             if not (klines_response and klines_response.get("retCode") == 0):
                 logger.warning(
-                    f"Не удалось получить свечи для {symbol}: {klines_response.get('retMsg', 'Неизвестная ошибка')}"
+                    "Не удалось получить свечи для %s: %s",
+                    symbol,
+                    klines_response.get("retMsg", "Неизвестная ошибка"),
                 )
                 continue
 
             klines = klines_response.get("result", {}).get("list", [])
             if not klines:
-                logger.warning(f"Нет данных свечей для {symbol}. Пропускаю.")
+                logger.warning("Нет данных свечей для %s. Пропускаю.", symbol)
                 continue
 
             # Bybit klines возвращает порядок: [startTime, open, high, low, close, volume, turnOver]
@@ -330,7 +629,9 @@ def fetch_and_write_screener(bybit_session, spreadsheet):
             # Убедимся, что данных достаточно для расчетов SMA
             if len(closes) < 90:  # Нужно как минимум 90 точек данных для SMA90
                 logger.warning(
-                    f"Недостаточно данных для {symbol} ({len(closes)} свечей). Пропускаю расчет SMA/ADX для этой пары."
+                    "Недостаточно данных для %s (%s свечей). Пропускаю расчет SMA/ADX для этой пары.",
+                    symbol,
+                    len(closes),
                 )
                 continue
 
@@ -358,56 +659,443 @@ def fetch_and_write_screener(bybit_session, spreadsheet):
         # Записываем в таблицу
         # .clear() удалит все, включая форматирование. Можно использовать update с пустыми данными,
         # если нужно сохранить форматирование, но для скринера обычно просто очищают.
-        screener_sheet.clear()
-        header = [["Pair", "SMA30", "SMA90", "ADX", "Vol", "Time"]]
-        screener_sheet.append_rows(
-            header + market_rows, value_input_option="USER_ENTERED"
-        )
-        logger.info(f"Успешно записано {len(market_rows)} строк в лист скринера.")
+        rewrite_screener_sheet(market_rows)
+        logger.info("Успешно записано %s строк в лист скринера.", len(market_rows))
         return f"✅ Данные скринера успешно обновлены\\. Добавлено *{len(market_rows)}* пар\\."
 
     except gspread.exceptions.APIError as e:
-        logger.error(f"Ошибка Google Sheets API в скринере: {e}", exc_info=True)
+        logger.error("Ошибка Google Sheets API в скринере: %s", e, exc_info=True)
         return f"❌ Ошибка Google Sheets API при обновлении скринера: {e}"
     except Exception as e:
-        logger.error(f"Произошла ошибка в fetch_and_write_screener: {e}", exc_info=True)
+        logger.error(
+            "Произошла ошибка в fetch_and_write_screener: %s", e, exc_info=True
+        )
         return f"❌ Произошла непредвиденная ошибка при обновлении скринера: {e}"
 
 
 # === Инициализация сервисов при старте ===
+mount_pooled_adapter(http_session)
+# telebot по умолчанию держит свою сессию в каждом потоке и пересоздает ее раз в 10 минут;
+# общая сессия с пулом переиспользует TLS-соединения с api.telegram.org всеми потоками
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = TG_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = TG_READ_TIMEOUT
 if not init_google_sheets():
     logger.error("CRITICAL: Failed to initialize Google Sheets.")
 if not init_bybit():
     logger.error("CRITICAL: Failed to initialize Bybit.")
+if bot and TELEGRAM_WEBHOOK_URL:
+    ensure_webhook()
 
 
 # === Вспомогательные функции ===
-def find_next_empty_row(sheet_instance, column_index=1):
-    """Находит номер следующей пустой строки по заданному столбцу (A по умолчанию)."""
-    if not sheet_instance:
-        logger.error("Sheet instance is None in find_next_empty_row")
-        return None
+def sheet_text(value):
+    """Текст, который USER_ENTERED запишет как есть, а не как формулу.
+
+    Даты и числа по-прежнему разбираются таблицей; строку вроде "=IMPORTXML(...)"
+    из сообщения пользователя защищает ведущий апостроф (в ячейке он не виден).
+    """
+    if isinstance(value, str) and value.startswith(("=", "+", "-", "@")):
+        return "'" + value
+    return value
+
+
+def build_trade_row(**values):
+    """Собирает строку "Таблицы сделок" по COL_IDX. None не перезаписывает ячейку (формулы остаются)."""
+    row = [None] * EXPECTED_COLUMNS
+    for name, value in values.items():
+        row[COL_IDX[name]] = sheet_text(value)
+    return row
+
+
+def next_trade_row():
+    """Номер строки после последней заполненной ячейки столбца A.
+
+    Не через values.append: тот пишет после первого непрерывного блока в A, и при
+    пропуске (строку удалили вручную) OVERWRITE затер бы сделки ниже него.
+    """
+    sheets_read_bucket.acquire()
+    col_a = sheet.col_values(1, value_render_option="UNFORMATTED_VALUE")
+    last = len(col_a)
+    while last and str(col_a[last - 1]).strip() == "":
+        last -= 1
+    return last + 1
+
+
+@google_retry()
+def write_trade_rows(first_row, rows):
+    """Пишет строки сделок начиная с first_row; None пропускается (формулы остаются).
+
+    Диапазон задан явно, поэтому повтор пишет те же значения в те же ячейки.
+    """
+    last_cell = f"{column_letter(EXPECTED_COLUMNS - 1)}{first_row + len(rows) - 1}"
+    sheet.spreadsheet.values_update(
+        gspread.utils.absolute_range_name(sheet.title, f"A{first_row}:{last_cell}"),
+        params={"valueInputOption": "USER_ENTERED"},
+        body={"values": rows},
+    )
+
+
+def append_trade_rows(rows):
+    """Дописывает строки после последней заполненной ячейки столбца A одним запросом записи.
+
+    Возвращает номер первой записанной строки.
+    """
+    first_row = next_trade_row()
+    write_trade_rows(first_row, rows)
+    return first_row
+
+
+def format_date_time(dt=None):
+    """Дата и время в формате таблицы ("дд.мм.гггг", "чч:мм:сс"); по умолчанию - текущий момент."""
+    if dt is None:
+        dt = datetime.datetime.now()
+    return (
+        f"{dt.day:02d}.{dt.month:02d}.{dt.year}",
+        f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}",
+    )
+
+
+def build_cell_updates(row_number, **values):
+    """Диапазоны batch_update для ячеек одной строки: имя столбца из COL_IDX -> значение.
+
+    Соседние столбцы объединяются в один диапазон (C и D -> "C5:D5").
+    """
+    updates = []
+    prev_idx = None
+    for name in sorted(values, key=COL_IDX.get):
+        idx = COL_IDX[name]
+        if idx - 1 == prev_idx:
+            # Продолжаем предыдущий диапазон вправо
+            updates[-1]["values"][0].append(values[name])
+            start = updates[-1]["range"].split(":")[0]
+            updates[-1]["range"] = f"{start}:{COL_LETTER[name]}{row_number}"
+        else:
+            cell = f"{COL_LETTER[name]}{row_number}"
+            updates.append({"range": cell, "values": [[values[name]]]})
+        prev_idx = idx
+    return updates
+
+
+def read_trade_columns():
+    """Столбцы пары (E) и фактической цены выхода (T) со 2-й строки одним batch_get.
+
+    Читаются только два нужных столбца вместо всего листа, по столбцам (COLUMNS):
+    каждый приходит плоским списком, без обёртки [..] на каждую строку.
+    """
+    asset_col = COL_LETTER["pair"]
+    exit_col = COL_LETTER["exit_price_actual"]
+    sheets_read_bucket.acquire()
+    asset_range, exit_range = sheet.batch_get(
+        [f"{asset_col}2:{asset_col}", f"{exit_col}2:{exit_col}"],
+        major_dimension="COLUMNS",
+        value_render_option="UNFORMATTED_VALUE",
+    )
+    # Пустой столбец приходит без values; хвостовые пустые ячейки API обрезает
+    asset_values = asset_range[0] if asset_range else []
+    exit_values = exit_range[0] if exit_range else []
+    logger.info(
+        "Fetched %s rows of columns %s/%s.", len(asset_values), asset_col, exit_col
+    )
+    return asset_values, exit_values
+
+
+def find_open_trade_row(asset, columns=None, taken=()):
+    """Ищет снизу вверх последнюю сделку по паре без цены выхода. Возвращает номер строки или None.
+
+    columns - уже прочитанный результат read_trade_columns(); строки из taken пропускаются
+    (их закрывают другие записи из очереди).
+    """
+    asset_values, exit_values = columns if columns is not None else read_trade_columns()
+    asset = asset.upper()
+    for i in range(len(asset_values) - 1, -1, -1):
+        row_number = i + 2  # Данные начинаются со 2-й строки
+        if row_number in taken:
+            continue
+        asset_in_row = str(asset_values[i]).upper()
+        exit_in_row = exit_values[i] if i < len(exit_values) else ""
+        if asset_in_row == asset and exit_in_row == "":
+            return row_number
+    return None
+
+
+@google_retry(idempotent=False)
+def append_glossary_row(term, definition):
+    """Дописывает термин и определение в конец листа "Глоссарий"."""
+    glossary_sheet.append_row(
+        [sheet_text(term), sheet_text(definition)], value_input_option="USER_ENTERED"
+    )
+
+
+def fetch_order_executions(order_id):
+    """Все исполнения ордера Bybit.
+
+    Исполнения полностью исполненного ордера кэшируются на ORDER_EXEC_CACHE_TTL секунд.
+    """
+    now = time.monotonic()
+    with order_exec_cache_lock:
+        cached = order_exec_cache.get(order_id)
+        if cached and cached[0] > now:
+            logger.info("Using cached executions for order %s.", order_id)
+            return cached[1]
+    executions = load_order_executions(order_id)
+    # leavesQty == 0 у последней части - ордер исполнен целиком, новых исполнений не будет
+    if any(float(e.get("leavesQty") or "nan") == 0 for e in executions):
+        with order_exec_cache_lock:
+            if len(order_exec_cache) >= ORDER_EXEC_CACHE_SIZE:
+                order_exec_cache.pop(next(iter(order_exec_cache)))
+            order_exec_cache[order_id] = (now + ORDER_EXEC_CACHE_TTL, executions)
+    return executions
+
+
+def load_order_executions(order_id):
+    """Запрашивает у Bybit все исполнения ордера, постранично по nextPageCursor (лимит API - 100)."""
+    executions = []
+    cursor = None
+    while True:
+        params = {"category": BYBIT_CATEGORY, "orderId": order_id, "limit": 100}
+        if cursor:
+            params["cursor"] = cursor
+        response = bybit_session.get_executions(**params)
+        if not (response and response.get("retCode") == 0):
+            raise RuntimeError(f"get_executions failed: {response}")
+        result = response.get("result", {})
+        executions.extend(result.get("list", []))
+        cursor = result.get("nextPageCursor")
+        if not cursor:
+            return executions
+
+
+# === Фоновая запись в таблицу ===
+def enqueue_trade_row(message, row, describe, order_id=None):
+    """Ставит строку сделки в очередь; describe(row_number) дает текст ответа пользователю.
+
+    С order_id строка не пишется, если этот ордер уже есть в столбце AD.
+    """
+    sheet_write_queue.put(
+        {
+            "message": message,
+            "row": row,
+            "describe": describe,
+            "order_id": order_id,
+            "attempts": 0,
+        }
+    )
+    logger.debug("Queued trade row: %s", row)
+
+
+def enqueue_trade_close(message, asset, values, reply):
+    """Ставит в очередь закрытие последней открытой сделки по паре.
+
+    values - ячейки закрытия по именам COL_IDX; reply уходит пользователю после записи.
+    """
+    sheet_write_queue.put(
+        {
+            "message": message,
+            "asset": asset,
+            "values": values,
+            "reply": reply,
+            "attempts": 0,
+        }
+    )
+    logger.debug("Queued close of %s: %s", asset, values)
+
+
+def notify_user(message, text):
+    """Ставит ответ в очередь отправки: поток записи не ждет лимиты Telegram."""
+    notify_queue.put((message, text))
+
+
+def notifier_loop():
+    """Фоновый поток: отправляет ответы о записи в таблицу.
+
+    Лимит группы (TG_GROUP_RATE в минуту) задерживает только этот поток, а не запись
+    в таблицу для всех чатов.
+    """
+    while True:
+        message, text = notify_queue.get()
+        try:
+            bot.reply_to(message, text)
+        except Exception as e:
+            logger.error("Failed to notify chat %s: %s", message.chat.id, e)
+
+
+def retry_or_drop(items):
+    """Возвращает неудавшиеся записи в очередь; после SHEET_WRITE_MAX_ATTEMPTS сообщает об ошибке."""
+    for item in items:
+        item["attempts"] += 1
+        if item["attempts"] < SHEET_WRITE_MAX_ATTEMPTS:
+            sheet_write_queue.put(item)
+            continue
+        logger.error("Dropping queued write after retries: %s", item)
+        claimed_close_rows.discard(item.get("row_number"))
+        notify_user(item["message"], "Ошибка: не удалось записать сделку в таблицу.")
+
+
+def recorded_order_ids():
+    """Order ID, уже записанные в столбец AD."""
+    sheets_read_bucket.acquire()
+    values = sheet.col_values(
+        COL_IDX["entry_order_id"] + 1, value_render_option="UNFORMATTED_VALUE"
+    )
+    return {str(value) for value in values[1:] if value}
+
+
+def skip_recorded_orders(items):
+    """Убирает из пачки строки ордеров, которые уже есть в таблице или раньше в этой пачке.
+
+    /fetch пишет весь ордер (все исполнения) одной строкой, и второй Exec ID того же
+    ордера посчитал бы позицию дважды.
+    """
+    if not any(item.get("order_id") for item in items):
+        return items
+    recorded = recorded_order_ids()
+    kept = []
+    for item in items:
+        order_id = item.get("order_id")
+        if order_id in recorded:
+            logger.info("Order %s is already in the sheet, row skipped.", order_id)
+            notify_user(
+                item["message"],
+                f"Ордер {order_id} уже есть в таблице, строка не добавлена.",
+            )
+            continue
+        if order_id:
+            recorded.add(order_id)
+        kept.append(item)
+    return kept
+
+
+def write_queued_rows(items):
+    """Дописывает строки новых сделок одним запросом записи. Возвращает True при успехе."""
     try:
-        logger.debug(f"Fetching column {column_index} values...")
-        col_values = sheet_instance.col_values(
-            column_index, value_render_option="UNFORMATTED_VALUE"
+        items = skip_recorded_orders(items)
+        if not items:
+            return True
+        first_row = append_trade_rows([item["row"] for item in items])
+    except Exception as e:
+        logger.error(
+            "Error appending %s queued row(s): %s", len(items), e, exc_info=True
         )
-        logger.debug(f"Found {len(col_values)} values.")
-        # Ищем последнюю непустую ячейку
-        last_data_row_index = len(col_values) - 1
-        while (
-            last_data_row_index >= 0
-            and str(col_values[last_data_row_index]).strip() == ""
-        ):  # >= 0 чтобы учесть пустой лист
-            last_data_row_index -= 1
-        target_row_number = (
-            last_data_row_index + 2
-        )  # Следующая строка после последней непустой
-        logger.info(f"Target starting row for update is {target_row_number}.")
-        return target_row_number
+        retry_or_drop(items)
+        return False
+    logger.info("Appended %s queued row(s) starting at row %s.", len(items), first_row)
+    for offset, item in enumerate(items):
+        notify_user(item["message"], item["describe"](first_row + offset))
+    return True
+
+
+@google_retry()
+def batch_update_ranges(data):
+    """Один values.batchUpdate по абсолютным диапазонам; те же значения в те же ячейки - повтор безопасен."""
+    sheet.spreadsheet.values_batch_update(
+        body={"valueInputOption": "USER_ENTERED", "data": data}
+    )
+
+
+def write_queued_closes(items):
+    """Закрывает сделки из очереди одним batch_update. Возвращает True при успехе.
+
+    Открытая строка ищется здесь, при записи, а не в обработчике: иначе два быстрых
+    /close по одной паре выбрали бы одну строку, а /close сразу после /add не нашел бы
+    сделку. Найденная строка запоминается в записи, чтобы повтор не закрыл другую.
+    """
+    if any("row_number" not in item for item in items):
+        try:
+            columns = read_trade_columns()
+        except Exception as e:
+            logger.error("Error reading open trades: %s", e, exc_info=True)
+            retry_or_drop(items)
+            return False
+        resolved = []
+        for item in items:
+            if "row_number" not in item:
+                row_number = find_open_trade_row(
+                    item["asset"], columns, claimed_close_rows
+                )
+                if not row_number:
+                    logger.info("No open trade found for %s.", item["asset"])
+                    notify_user(
+                        item["message"],
+                        f"Не найдена ОТКРЫТАЯ сделка по {item['asset']}.",
+                    )
+                    continue
+                item["row_number"] = row_number
+                claimed_close_rows.add(row_number)
+            resolved.append(item)
+        items = resolved
+        if not items:
+            return True
+    # Прямой values.batchUpdate: Worksheet.batch_update переписывает range в переданных
+    # словарях, и при повторе из очереди имя листа добавлялось бы второй раз
+    data = [
+        {
+            "range": gspread.utils.absolute_range_name(sheet.title, update["range"]),
+            "values": update["values"],
+        }
+        for item in items
+        for update in build_cell_updates(item["row_number"], **item["values"])
+    ]
+    try:
+        batch_update_ranges(data)
     except Exception as e:
-        logger.error(f"Error finding next empty row: {e}", exc_info=True)
-        return None
+        logger.error(
+            "Error closing %s queued trade(s): %s", len(items), e, exc_info=True
+        )
+        retry_or_drop(items)
+        return False
+    logger.info("Closed rows %s.", ", ".join(str(item["row_number"]) for item in items))
+    for item in items:
+        claimed_close_rows.discard(item["row_number"])
+        notify_user(item["message"], item["reply"])
+    return True
+
+
+def sheet_writer_loop():
+    """Фоновый поток: пишет в таблицу накопившиеся новые сделки и закрытия сделок."""
+    while True:
+        pending = [sheet_write_queue.get()]
+        # Даем соседним командам попасть в ту же пачку
+        time.sleep(SHEET_WRITE_BATCH_DELAY)
+        while len(pending) < SHEET_WRITE_MAX_BATCH:
+            try:
+                pending.append(sheet_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        ok = True
+        new_rows = [item for item in pending if "row" in item]
+        if new_rows:
+            ok = write_queued_rows(new_rows) and ok
+        # Закрытия - после новых строк, чтобы /close сразу после /add нашел сделку.
+        # Все закрытия из пачки - один batch_update (квота Google считает запросы, а не ячейки)
+        closes = [item for item in pending if "asset" in item]
+        if closes:
+            ok = write_queued_closes(closes) and ok
+        if not ok:
+            time.sleep(SHEET_WRITE_RETRY_DELAY)
+
+
+threading.Thread(target=sheet_writer_loop, name="sheet-writer", daemon=True).start()
+threading.Thread(target=notifier_loop, name="telegram-notifier", daemon=True).start()
+
+
+def google_token_refresh_loop():
+    """Фоновый поток: заранее обновляет OAuth-токен сервисного аккаунта Google."""
+    auth_request = GoogleAuthRequest(session=http_session)
+    while True:
+        time.sleep(GOOGLE_TOKEN_REFRESH_INTERVAL)
+        try:
+            google_creds.refresh(auth_request)
+            logger.info("Google token refreshed, valid until %s.", google_creds.expiry)
+        except Exception as e:
+            # Не страшно: AuthorizedSession сам обновит токен при следующем запросе
+            logger.error("Background Google token refresh failed: %s", e)
+
+
+if google_creds:
+    threading.Thread(
+        target=google_token_refresh_loop, name="google-token-refresh", daemon=True
+    ).start()
 
 
 # === Обработчики команд и Кнопок ===
@@ -449,7 +1137,6 @@ if bot:  # Только если бот инициализирован
             parse_mode="Markdown",
         )
 
-    @bot.message_handler(func=lambda m: m.text == "Скрыть меню")
     def hide_menu(message):
         """Скрывает клавиатуру."""
         bot.send_message(
@@ -457,7 +1144,6 @@ if bot:  # Только если бот инициализирован
         )
 
     # --- ОБРАБОТЧИК КНОПКИ "Добавить вручную (/add)" ---
-    @bot.message_handler(func=lambda message: message.text == "Добавить вручную (/add)")
     def kb_add_manual_prompt(message):
         """Напоминает формат команды /add для ручного ввода."""
         bot.reply_to(
@@ -471,102 +1157,74 @@ if bot:  # Только если бот инициализирован
     # /add - Обработчик самой команды
     @bot.message_handler(commands=["add"])
     def handle_add(message):
-        # ... (Код функции handle_add без изменений) ...
+        """/add: добавляет сделку, введенную вручную."""
         chat_id = message.chat.id
-        logger.info(f"Received /add command from {chat_id}: {message.text}")
+        logger.info("Received /add command from %s: %s", chat_id, message.text)
         if not sheet:
             logger.error("Sheet not initialized in /add")
             bot.reply_to(message, "Ошибка: Нет подключения к Google Sheets.")
             return
         try:
-            parts = message.text.split()
-            if len(parts) != 8:
+            m = _ADD_RE.match(message.text)
+            if not m:
                 logger.warning("Invalid format for /add...")
                 bot.reply_to(
                     message,
-                    "Неверный формат! Нужно 8 частей.\nПример:\n`/add SOL/USDT Лонг 139.19 141.8 136.9 1.5 <Bybit_Order_ID>`",
+                    "Неверный формат! Нужно: пара, Лонг/Шорт, 4 числа и Order ID.\nПример:\n`/add SOL/USDT Лонг 139.19 141.8 136.9 1.5 <Bybit_Order_ID>`",
                     parse_mode="Markdown",
                 )
                 return
-            (
-                _,
-                asset,
-                direction,
-                entry_price_str,
-                tp_str,
-                sl_str,
-                amount_str,
-                bybit_order_id,
-            ) = parts
-            now = datetime.datetime.now()
-            entry_date = now.strftime("%d.%m.%Y")
-            entry_time = now.strftime("%H:%M:%S")
-            target_row_number = find_next_empty_row(sheet)
-            if not target_row_number:
-                bot.reply_to(message, "Ошибка: не удалось найти пустую строку.")
-                return
-            updates = []
+            asset = m["asset"]
+            direction = m["dir"].capitalize()
+            bybit_order_id = m["oid"]
+            entry_date, entry_time = format_date_time()
             try:
-                updates.append(
-                    {"range": f"A{target_row_number}", "values": [[entry_date]]}
-                )
-                updates.append(
-                    {"range": f"B{target_row_number}", "values": [[entry_time]]}
-                )
-                updates.append({"range": f"E{target_row_number}", "values": [[asset]]})
-                updates.append(
-                    {"range": f"F{target_row_number}", "values": [[direction]]}
-                )
-                updates.append(
-                    {
-                        "range": f"G{target_row_number}",
-                        "values": [[float(entry_price_str)]],
-                    }
-                )
-                updates.append(
-                    {"range": f"H{target_row_number}", "values": [[float(sl_str)]]}
+                entry_price, tp_price, sl_price, amount = map(
+                    float, m.group("entry", "tp", "sl", "qty")
                 )
-                updates.append(
-                    {"range": f"I{target_row_number}", "values": [[float(tp_str)]]}
-                )
-                updates.append(
-                    {"range": f"J{target_row_number}", "values": [[float(amount_str)]]}
-                )
-                # Записываем Order ID в AD (индекс 29)
-                if "entry_order_id" in COL_IDX and COL_IDX["entry_order_id"] == 29:
-                    updates.append(
-                        {
-                            "range": f"AD{target_row_number}",
-                            "values": [[bybit_order_id]],
-                        }
-                    )
-                else:
-                    logger.warning(
-                        "Column AD for Entry Order ID not found or incorrect index."
-                    )
             except ValueError as e:
-                logger.error(f"ValueError converting numbers in /add: {e}")
+                logger.error("ValueError converting numbers in /add: %s", e)
                 bot.reply_to(message, f"Ошибка в формате чисел: {e}.")
                 return
-            logger.debug(f"Prepared batch update data for /add: {updates}")
-            sheet.batch_update(updates, value_input_option="USER_ENTERED")
-            logger.info(
-                f"Updated cells via /add for {asset} (Order ID: {bybit_order_id}) in row {target_row_number}."
+            row = build_trade_row(
+                entry_date=entry_date,
+                entry_time=entry_time,
+                pair=asset,
+                type=direction,
+                entry_price=entry_price,
+                sl_price=sl_price,
+                tp_price=tp_price,
+                volume_coins=amount,
+                entry_order_id=bybit_order_id,
             )
-            bot.reply_to(
+            enqueue_trade_row(
                 message,
-                f"Сделка по {asset} (ID: {bybit_order_id}) ДОБАВЛЕНА ВРУЧНУЮ в строку {target_row_number}!",
+                row,
+                lambda row_number: f"Сделка по {asset} (ID: {bybit_order_id}) ДОБАВЛЕНА ВРУЧНУЮ в строку {row_number}!",
             )
+            logger.info("Queued /add for %s (Order ID: %s).", asset, bybit_order_id)
         except Exception as e:
-            logger.error(f"Error processing /add command: {e}", exc_info=True)
+            logger.error("Error processing /add command: %s", e, exc_info=True)
             bot.reply_to(message, "Ошибка при обработке /add.")
 
     # /fetch - Обработчик самой команды (использует execId)
     @bot.message_handler(commands=["fetch"])
     def handle_fetch(message):
-        # ... (Код функции handle_fetch без изменений, использует get_executions с execId) ...
-        chat_id = message.chat.id
-        logger.info(f"Received /fetch command from {chat_id}: {message.text}")
+        """/fetch: разбирает команду и добавляет сделку по ID исполнения Bybit."""
+        logger.info(
+            "Received /fetch command from %s: %s", message.chat.id, message.text
+        )
+        m = _FETCH_RE.match(message.text)
+        if not m:
+            return bot.reply_to(
+                message,
+                "Неверный формат!\nПример:\n`/fetch <Bybit_Exec_ID>`",
+                parse_mode="Markdown",
+            )
+        fetch_execution(message, m["exec_id"])
+
+    def fetch_execution(message, exec_id_to_fetch):
+        """Добавляет сделку по ID исполнения Bybit (все части ордера)."""
         if not sheet or not bybit_session:
             error_msg = "Ошибка: " + (
                 "Нет Google Sheets." if not sheet else "Нет Bybit API."
@@ -574,127 +1232,131 @@ if bot:  # Только если бот инициализирован
             logger.error(error_msg)
             return bot.reply_to(message, error_msg)
         try:
-            parts = message.text.split()
-            if len(parts) != 2:
-                return bot.reply_to(
-                    message,
-                    "Неверный формат!\nПример:\n`/fetch <Bybit_Exec_ID>`",
-                    parse_mode="Markdown",
-                )
-            exec_id_to_fetch = parts[1]
-            logger.info(f"Fetching execution details for Exec ID: {exec_id_to_fetch}")
+            logger.info("Fetching execution details for Exec ID: %s", exec_id_to_fetch)
             response = bybit_session.get_executions(
                 execId=exec_id_to_fetch, category=BYBIT_CATEGORY, limit=1
             )
             logger.debug(
-                f"Raw Bybit Executions response for {exec_id_to_fetch}: {response}"
+                "Raw Bybit Executions response for %s: %s", exec_id_to_fetch, response
             )
             if not (response and response.get("retCode") == 0):
-                logger.error(f"Error fetching execution: {response}")
+                logger.error("Error fetching execution: %s", response)
                 return bot.reply_to(
                     message,
                     f"Ошибка запроса транз. {exec_id_to_fetch}: {response.get('retMsg', 'Error')}",
                 )
             exec_list = response.get("result", {}).get("list", [])
             if not exec_list:
-                logger.warning(f"No execution found for Exec ID: {exec_id_to_fetch}")
+                logger.warning("No execution found for Exec ID: %s", exec_id_to_fetch)
                 return bot.reply_to(
                     message, f"Не найдено исполнение (транз.) с ID {exec_id_to_fetch}."
                 )
             exec_item = exec_list[0]
+            related_order_id = exec_item.get("orderId", "")
+            # Ордер мог исполниться несколькими частями - собираем все его исполнения
+            order_execs = exec_list
+            if related_order_id:
+                try:
+                    order_execs = fetch_order_executions(related_order_id) or exec_list
+                except Exception as e:
+                    # Запрошенное исполнение уже есть - записываем хотя бы его
+                    logger.warning(
+                        "Could not load all executions of order %s, using exec %s only: %s",
+                        related_order_id,
+                        exec_id_to_fetch,
+                        e,
+                    )
+            logger.info(
+                "Order %s has %s execution(s).", related_order_id, len(order_execs)
+            )
             try:
                 asset = exec_item.get("symbol", "")
                 side = "Лонг" if exec_item.get("side") == "Buy" else "Шорт"
-                entry_price = float(exec_item.get("execPrice") or 0)
-                total_qty = float(exec_item.get("execQty") or 0)
-                exec_time_ms = int(exec_item.get("execTime", 0))
+                total_qty = 0.0
+                notional = 0.0
+                fee = 0.0
+                exec_time_ms = 0
+                for item in order_execs:
+                    qty = float(item.get("execQty") or 0)
+                    total_qty += qty
+                    notional += qty * float(item.get("execPrice") or 0)
+                    fee += float(item.get("execFee") or 0)
+                    item_time_ms = int(item.get("execTime") or 0)
+                    if item_time_ms and (
+                        not exec_time_ms or item_time_ms < exec_time_ms
+                    ):
+                        exec_time_ms = item_time_ms
+                # Средневзвешенная цена входа по всем частям ордера
+                entry_price = notional / total_qty if total_qty > 0 else 0.0
                 entry_dt = (
                     datetime.datetime.fromtimestamp(exec_time_ms / 1000)
                     if exec_time_ms > 0
                     else None
                 )
-                entry_date_str = entry_dt.strftime("%d.%m.%Y") if entry_dt else ""
-                entry_time_str = entry_dt.strftime("%H:%M:%S") if entry_dt else ""
-                related_order_id = exec_item.get("orderId", "")
-                fee = float(exec_item.get("execFee", 0))
+                if entry_dt:
+                    entry_date_str, entry_time_str = format_date_time(entry_dt)
+                else:
+                    # Столбец A не должен оставаться пустым: по нему ищется конец данных
+                    logger.warning(
+                        "Execution %s has no execTime, entry date set to '%s'.",
+                        exec_id_to_fetch,
+                        MISSING_ENTRY_DATE,
+                    )
+                    entry_date_str, entry_time_str = MISSING_ENTRY_DATE, None
                 if not asset or total_qty <= 0:
-                    logger.error(f"Incomplete data for {exec_id_to_fetch}")
+                    logger.error("Incomplete data for %s", exec_id_to_fetch)
                     return bot.reply_to(
                         message, f"Неполные данные для транз. {exec_id_to_fetch}."
                     )
             except (ValueError, TypeError, KeyError, IndexError) as e:
                 logger.error(
-                    f"Error parsing execution data: {e}. Data: {exec_item}",
+                    "Error parsing execution data: %s. Data: %s",
+                    e,
+                    exec_item,
                     exc_info=True,
                 )
                 return bot.reply_to(
                     message, f"Ошибка обработки данных транз. {exec_id_to_fetch}."
                 )
-            target_row_number = find_next_empty_row(sheet)
-            if not target_row_number:
-                return bot.reply_to(message, "Ошибка: не удалось найти пустую строку.")
-            updates = [
-                {"range": f"A{target_row_number}", "values": [[entry_date_str]]},
-                {"range": f"B{target_row_number}", "values": [[entry_time_str]]},
-                {"range": f"E{target_row_number}", "values": [[asset]]},
-                {"range": f"F{target_row_number}", "values": [[side]]},
-                {"range": f"G{target_row_number}", "values": [[entry_price]]},
-                {"range": f"J{target_row_number}", "values": [[total_qty]]},
-                {"range": f"Q{target_row_number}", "values": [[fee]]},  # Комиссия в Q
-                {
-                    "range": f"AD{target_row_number}",
-                    "values": [[related_order_id]],
-                },  # OrderID в AD
-                {
-                    "range": f"AC{target_row_number}",
-                    "values": [[exec_id_to_fetch]],
-                },  # ExecID в AC
-            ]
-            logger.debug(f"Prepared batch update data for /fetch: {updates}")
-            sheet.batch_update(updates, value_input_option="USER_ENTERED")
-            logger.info(
-                f"Updated cells via /fetch for {asset} (Exec ID: {exec_id_to_fetch}) in row {target_row_number}."
+            row = build_trade_row(
+                entry_date=entry_date_str,
+                entry_time=entry_time_str,
+                pair=asset,
+                type=side,
+                entry_price=entry_price,
+                volume_coins=total_qty,
+                commission_entry=fee,
+                bybit_exec_id=exec_id_to_fetch,
+                entry_order_id=related_order_id,
             )
-            bot.reply_to(
+            enqueue_trade_row(
                 message,
-                f"Сделка по {asset} (Exec ID: {exec_id_to_fetch}) добавлена из Bybit в строку {target_row_number}!",
+                row,
+                lambda row_number: f"Сделка по {asset} (Exec ID: {exec_id_to_fetch}) добавлена из Bybit в строку {row_number}!",
+                order_id=related_order_id,
             )
+            logger.info("Queued /fetch for %s (Exec ID: %s).", asset, exec_id_to_fetch)
         except Exception as e:
-            logger.error(f"Error processing /fetch command: {e}", exc_info=True)
+            logger.error("Error processing /fetch command: %s", e, exc_info=True)
             bot.reply_to(message, "Ошибка при обработке /fetch.")
 
     # --- Обработчик для кнопки "Добавить по ID Транз. (/fetch)" ---
-    @bot.message_handler(
-        func=lambda message: message.text == "Добавить по ID Транз. (/fetch)"
-    )
     def kb_addid(message):
         """Запрашивает ID Транзакции для вызова /fetch."""
         msg = bot.send_message(
             message.chat.id, "Введите ID ТРАНЗАКЦИИ (Exec ID) с Bybit:"
         )
-        bot.register_next_step_handler(msg, fetch_wrapper_for_next_step)
-
-    def fetch_wrapper_for_next_step(message):
-        """Обертка для вызова handle_fetch из next_step_handler."""
-        logger.info(f"Received Exec ID '{message.text}' via next_step_handler")
-        # Создаем объект, похожий на сообщение с командой
-        fake_command_message = type(
-            "FakeCommandMessage",
-            (object,),
-            {
-                "text": f"/fetch {message.text.strip()}",  # Формируем команду /fetch с ID
-                "chat": message.chat,
-                "from_user": message.from_user,
-                "message_id": message.message_id,
-            },
-        )()
-        # Вызываем основной обработчик команды /fetch
-        handle_fetch(fake_command_message)
+        bot.register_next_step_handler(msg, process_exec_id_input)
+
+    def process_exec_id_input(message):
+        """Получает Exec ID из ответа пользователя и сразу добавляет сделку."""
+        logger.info("Received Exec ID '%s' via next_step_handler", message.text)
+        exec_id = (message.text or "").strip()
+        if not exec_id or " " in exec_id:
+            return bot.reply_to(message, "Нужен один ID транзакции (Exec ID).")
+        fetch_execution(message, exec_id)
 
     # --- Обработчик для кнопки "Закрыть сделку" ---
-    @bot.message_handler(
-        func=lambda message: message.text == "Закрыть сделку"
-    )  # Убрал /close из текста
     def kb_close_trade_prompt(message):
         """Спрашивает пару и цену для закрытия."""
         msg = bot.send_message(
@@ -706,112 +1368,60 @@ if bot:  # Только если бот инициализирован
 
     def process_close_trade_input(message):
         """Обрабатывает ответ пользователя с парой и ценой, закрывает сделку."""
-        # ... (Код функции process_close_trade_input без изменений) ...
         chat_id = message.chat.id
-        logger.info(f"Received close trade input from {chat_id}: {message.text}")
+        logger.info("Received close trade input from %s: %s", chat_id, message.text)
         if not sheet:
             logger.error("Sheet not initialized...")
             return bot.send_message(chat_id, "Ошибка: Нет Google Sheets.")
         try:
-            parts = message.text.split()
-            if len(parts) != 2:
-                logger.warning(f"Invalid format for close input: {parts}")
+            m = _CLOSE_INPUT_RE.match(message.text or "")
+            if not m:
+                logger.warning("Invalid format for close input: %s", message.text)
                 msg = bot.send_message(
                     chat_id, "Неверный формат. Нужно ПАРУ и ЦЕНУ. Попробуйте еще раз:"
                 )
                 bot.register_next_step_handler(msg, process_close_trade_input)
                 return
-            asset_to_close = parts[0].upper()
-            exit_price_str = parts[1].replace(",", ".")
+            asset_to_close = m["asset"].upper()
+            exit_price_str = m["price"].replace(",", ".")
             exit_price = float(exit_price_str)
-            now = datetime.datetime.now()
-            exit_date = now.strftime("%d.%m.%Y")
-            exit_time = now.strftime("%H:%M:%S")
+            exit_date, exit_time = format_date_time()
             exit_method = "вручную (кнопка)"
-            list_of_lists = sheet.get_all_values()
-            logger.info(f"Fetched {len(list_of_lists)} rows for button close.")
-            header_row = list_of_lists[0] if list_of_lists else []
-            asset_col_name = "Торгуемая пара (актив)"
-            actual_exit_price_col_name = "Фактическая цена выхода ($)"
-            try:
-                asset_col_index = header_row.index(asset_col_name)
-                actual_exit_price_col_index = header_row.index(
-                    actual_exit_price_col_name
-                )
-            except (ValueError, IndexError) as e:
-                logger.error(f"Header error in button close: {e}")
-                return bot.send_message(chat_id, "Крит. ошибка: Не найдены столбцы.")
-            found = False
-            for i in range(len(list_of_lists) - 1, 0, -1):
-                row = list_of_lists[i]
-                current_row_number = i + 1
-                if len(row) > max(asset_col_index, actual_exit_price_col_index):
-                    asset_in_row = row[asset_col_index].upper()
-                    exit_price_in_row = row[actual_exit_price_col_index]
-                    if asset_in_row == asset_to_close and (
-                        exit_price_in_row == "" or exit_price_in_row is None
-                    ):
-                        logger.info(
-                            f"Found open trade for {asset_to_close} at row {current_row_number}. Closing via button..."
-                        )
-                        updates = [
-                            {
-                                "range": f"C{current_row_number}",
-                                "values": [[exit_date]],
-                            },
-                            {
-                                "range": f"D{current_row_number}",
-                                "values": [[exit_time]],
-                            },
-                            {
-                                "range": f"S{current_row_number}",
-                                "values": [[exit_method]],
-                            },
-                            {
-                                "range": f"T{current_row_number}",
-                                "values": [[exit_price]],
-                            },
-                        ]
-                        sheet.batch_update(updates, value_input_option="USER_ENTERED")
-                        logger.info(
-                            f"Updated row {current_row_number} for button closed trade {asset_to_close}."
-                        )
-                        bot.send_message(
-                            chat_id,
-                            f"Сделка по {asset_to_close} закрыта вручную по {exit_price}.",
-                        )
-                        found = True
-                        break
-            if not found:
-                logger.info(
-                    f"No open trade found for {asset_to_close} via button close."
-                )
-                bot.send_message(
-                    chat_id, f"Не найдена ОТКРЫТАЯ сделка по {asset_to_close}."
-                )
+            enqueue_trade_close(
+                message,
+                asset_to_close,
+                dict(
+                    exit_date=exit_date,
+                    exit_time=exit_time,
+                    exit_method=exit_method,
+                    exit_price_actual=exit_price,
+                ),
+                f"Сделка по {asset_to_close} закрыта вручную по {exit_price}.",
+            )
+            logger.info("Queued close of %s (button).", asset_to_close)
         except ValueError:
             logger.error(
-                f"ValueError converting close price: {exit_price_str}", exc_info=True
+                "ValueError converting close price: %s", exit_price_str, exc_info=True
             )
             msg = bot.send_message(chat_id, "Ошибка формата цены. Попробуйте еще раз:")
             bot.register_next_step_handler(msg, process_close_trade_input)
         except Exception as e:
-            logger.error(f"Error processing close trade input: {e}", exc_info=True)
+            logger.error("Error processing close trade input: %s", e, exc_info=True)
             bot.send_message(chat_id, "Ошибка при закрытии сделки.")
 
     # /close - Обработчик самой команды (оставляем для прямого ввода)
     @bot.message_handler(commands=["close"])
     def handle_close(message):
-        # ... (Код функции handle_close без изменений) ...
+        """/close: закрывает последнюю открытую сделку по паре."""
         chat_id = message.chat.id
-        logger.info(f"Received /close command from {chat_id}: {message.text}")
+        logger.info("Received /close command from %s: %s", chat_id, message.text)
         if not sheet:
             logger.error("Sheet not initialized in /close")
             bot.reply_to(message, "Ошибка: Нет подключения к Google Sheets.")
             return
         try:
-            parts = message.text.split()
-            if len(parts) != 3:
+            m = _CLOSE_RE.match(message.text)
+            if not m:
                 logger.warning("Invalid format for /close...")
                 bot.reply_to(
                     message,
@@ -819,93 +1429,30 @@ if bot:  # Только если бот инициализирован
                     parse_mode="Markdown",
                 )
                 return
-            _, asset_to_close, exit_price_str = parts
+            asset_to_close = m["asset"]
+            exit_price_str = m["price"]
             exit_price = float(exit_price_str)
-            now = datetime.datetime.now()
-            exit_date = now.strftime("%d.%m.%Y")
-            exit_time = now.strftime("%H:%M:%S")
+            exit_date, exit_time = format_date_time()
             exit_method = "вручную"
-            list_of_lists = sheet.get_all_values()
-            logger.info(f"Fetched {len(list_of_lists)} rows for /close.")
-            header_row = list_of_lists[0] if list_of_lists else []
-            logger.debug(f"Header row: {header_row}")
-            asset_col_name = "Торгуемая пара (актив)"
-            actual_exit_price_col_name = "Фактическая цена выхода ($)"  # T
-            exit_date_col_letter = "C"
-            exit_time_col_letter = "D"
-            exit_method_col_letter = "S"
-            actual_exit_price_col_letter = "T"
-            try:
-                asset_col_index = header_row.index(asset_col_name)
-                actual_exit_price_col_index = header_row.index(
-                    actual_exit_price_col_name
-                )
-            except ValueError as e:
-                logger.error(f"Column name mismatch in /close: '{e}'")
-                bot.reply_to(message, f"Критическая ошибка: Не найден столбец '{e}'.")
-                return
-            except IndexError:
-                logger.error("Header row not found or empty in /close.")
-                bot.reply_to(message, "Критическая ошибка: Не найден заголовок.")
-                return
-            found = False
-            for i in range(len(list_of_lists) - 1, 0, -1):
-                row = list_of_lists[i]
-                current_row_number = i + 1
-                if len(row) > max(asset_col_index, actual_exit_price_col_index):
-                    asset_in_row = row[asset_col_index].upper()
-                    exit_price_in_row = row[
-                        actual_exit_price_col_index
-                    ]  # Сравниваем без upper()
-                    if asset_in_row == asset_to_close.upper() and (
-                        exit_price_in_row == "" or exit_price_in_row is None
-                    ):  # Сравниваем пару case-insensitive
-                        logger.info(
-                            f"Found open trade for {asset_to_close} at row {current_row_number}. Closing manually..."
-                        )
-                        updates = [
-                            {
-                                "range": f"{exit_date_col_letter}{current_row_number}",
-                                "values": [[exit_date]],
-                            },
-                            {
-                                "range": f"{exit_time_col_letter}{current_row_number}",
-                                "values": [[exit_time]],
-                            },
-                            {
-                                "range": f"{exit_method_col_letter}{current_row_number}",
-                                "values": [[exit_method]],
-                            },
-                            {
-                                "range": f"{actual_exit_price_col_letter}{current_row_number}",
-                                "values": [[exit_price]],
-                            },
-                        ]
-                        sheet.batch_update(updates, value_input_option="USER_ENTERED")
-                        logger.info(
-                            f"Updated row {current_row_number} for manually closed trade {asset_to_close}."
-                        )
-                        bot.reply_to(
-                            message,
-                            f"Сделка по {asset_to_close} закрыта вручную по {exit_price}.",
-                        )
-                        found = True
-                        break
-            if not found:
-                logger.info(
-                    f"No open trade found for {asset_to_close} to close manually."
-                )
-                bot.reply_to(
-                    message, f"Не найдена ОТКРЫТАЯ сделка по {asset_to_close}."
-                )
+            enqueue_trade_close(
+                message,
+                asset_to_close,
+                dict(
+                    exit_date=exit_date,
+                    exit_time=exit_time,
+                    exit_method=exit_method,
+                    exit_price_actual=exit_price,
+                ),
+                f"Сделка по {asset_to_close} закрыта вручную по {exit_price}.",
+            )
+            logger.info("Queued close of %s.", asset_to_close)
         except ValueError as e:
-            logger.error(f"ValueError processing /close: {e}")
+            logger.error("ValueError processing /close: %s", e)
             bot.reply_to(message, f"Ошибка в формате цены выхода: {e}.")
         except Exception as e:
-            logger.error(f"Error processing /close command: {e}", exc_info=True)
+            logger.error("Error processing /close command: %s", e, exc_info=True)
             bot.reply_to(message, "Ошибка при закрытии сделки.")
 
-    @bot.message_handler(func=lambda m: m.text == "Отчёт")
     @bot.message_handler(commands=["report"])
     def handle_report(message):
         """Отправляем запрос к Apps Script и подтверждаем пользователю."""
@@ -916,12 +1463,40 @@ if bot:  # Только если бот инициализирован
             return bot.reply_to(
                 message, "Ошибка: URL для генерации отчета не настроен."
             )
+        chat_id = message.chat.id
+        # Формируем запрос
+        url = f"{WEBAPP_URL}?func=weeklyReport&chat_id={chat_id}"
+        try:
+            # Используем requests для отправки GET-запроса
+            resp = http_session.get(url, timeout=10)
+            if resp.status_code == 200:
+                bot.reply_to(
+                    message, "Запрос отчёта отправлен! Отчёт придёт в этот чат."
+                )
+            else:
+                bot.reply_to(
+                    message, f"Ошибка при запросе отчёта: HTTP {resp.status_code}"
+                )
+            logger.info("/report → %s → %s / %s", url, resp.status_code, resp.text)
+        except (
+            requests.exceptions.RequestException
+        ) as e:  # Более специфичный обработчик ошибок requests
+            logger.error("Ошибка сети при запросе /report: %s", e, exc_info=True)
+            bot.reply_to(
+                message,
+                "Не удалось связаться со скриптом отчета (ошибка сети). Попробуйте позже.",
+            )
+        except Exception as e:
+            logger.error("Общая ошибка при запросе /report: %s", e, exc_info=True)
+            bot.reply_to(
+                message,
+                "Произошла непредвиденная ошибка при запросе отчета. Попробуйте позже.",
+            )
 
-    @bot.message_handler(func=lambda m: m.text == "Обновить Скринер")
     @bot.message_handler(commands=["screener"])
     def handle_screener_update(message):
         chat_id = message.chat.id
-        logger.info(f"Получена команда /screener от {chat_id}")
+        logger.info("Получена команда /screener от %s", chat_id)
 
         if not bybit_session:
             return bot.reply_to(message, "Ошибка: Нет подключения к Bybit API.")
@@ -940,43 +1515,13 @@ if bot:  # Только если бот инициализирован
             bot.send_message(chat_id, response_message, parse_mode="Markdown")
         except Exception as e:
             logger.error(
-                f"Ошибка при вызове fetch_and_write_screener: {e}", exc_info=True
+                "Ошибка при вызове fetch_and_write_screener: %s", e, exc_info=True
             )
             bot.send_message(
                 chat_id, "Произошла непредвиденная ошибка при обновлении скринера."
             )
 
-        # Формируем запрос
-        url = f"{WEBAPP_URL}?func=weeklyReport&chat_id={chat_id}"
-        try:
-            # Используем requests для отправки GET-запроса
-            resp = requests.get(url, timeout=10)
-            if resp.status_code == 200:
-                bot.reply_to(
-                    message, "Запрос отчёта отправлен! Отчёт придёт в этот чат."
-                )
-            else:
-                bot.reply_to(
-                    message, f"Ошибка при запросе отчёта: HTTP {resp.status_code}"
-                )
-            logger.info(f"/report → {url} → {resp.status_code} / {resp.text}")
-        except (
-            requests.exceptions.RequestException
-        ) as e:  # Более специфичный обработчик ошибок requests
-            logger.error(f"Ошибка сети при запросе /report: {e}", exc_info=True)
-            bot.reply_to(
-                message,
-                "Не удалось связаться со скриптом отчета (ошибка сети). Попробуйте позже.",
-            )
-        except Exception as e:
-            logger.error(f"Общая ошибка при запросе /report: {e}", exc_info=True)
-            bot.reply_to(
-                message,
-                "Произошла непредвиденная ошибка при запросе отчета. Попробуйте позже.",
-            )
-
     # --- НОВЫЕ ОБРАБОТЧИКИ ДЛЯ ГЛОССАРИЯ ---
-    @bot.message_handler(func=lambda message: message.text == "Глоссарий")
     def kb_glossary_start(message):
         """Запрашивает термин для поиска в глоссарии."""
         chat_id = message.chat.id
@@ -989,22 +1534,24 @@ if bot:  # Только если бот инициализирован
         """Ищет термин в глоссарии и отвечает."""
         chat_id = message.chat.id
         term_to_search = message.text.strip()
-        logger.info(f"User {chat_id} searching for term: {term_to_search}")
+        logger.info("User %s searching for term: %s", chat_id, term_to_search)
         if not glossary_sheet:
             return bot.send_message(chat_id, "Ошибка: Лист 'Глоссарий' не подключен.")
         if not term_to_search:
             return bot.send_message(chat_id, "Вы не ввели термин для поиска.")
         try:
+            sheets_read_bucket.acquire()
             cell = glossary_sheet.find(
                 term_to_search, in_column=1, case_sensitive=False
             )
             if cell:
+                sheets_read_bucket.acquire()
                 definition = glossary_sheet.cell(cell.row, 2).value
-                logger.info(f"Found term '{term_to_search}' at row {cell.row}.")
+                logger.info("Found term '%s' at row %s.", term_to_search, cell.row)
                 response = f"*{term_to_search.capitalize()}*\n\n{definition or 'Определение не найдено.'}"  # Используем Markdown
                 bot.send_message(chat_id, response, parse_mode="Markdown")
             else:
-                logger.info(f"Term '{term_to_search}' not found.")
+                logger.info("Term '%s' not found.", term_to_search)
                 response = f"Термин '{term_to_search}' не найден. Хотите добавить определение?\n\nЕсли да, просто напишите определение. Если нет, отправьте 'нет' или /cancel."
                 msg = bot.send_message(chat_id, response)
                 user_states[chat_id] = {
@@ -1015,14 +1562,17 @@ if bot:  # Только если бот инициализирован
         except (
             gspread.exceptions.CellNotFound
         ):  # На случай если find вернет None или ошибку
-            logger.info(f"Term '{term_to_search}' not found (CellNotFound exception).")
+            logger.info("Term '%s' not found (CellNotFound exception).", term_to_search)
             response = f"Термин '{term_to_search}' не найден. Хотите добавить определение?\n\nЕсли да, просто напишите определение. Если нет, отправьте 'нет' или /cancel."
             msg = bot.send_message(chat_id, response)
             user_states[chat_id] = {"action": "add_definition", "term": term_to_search}
             bot.register_next_step_handler(msg, process_glossary_add_definition)
         except Exception as e:
             logger.error(
-                f"Error searching glossary for '{term_to_search}': {e}", exc_info=True
+                "Error searching glossary for '%s': %s",
+                term_to_search,
+                e,
+                exc_info=True,
             )
             bot.send_message(chat_id, "Ошибка при поиске в глоссарии.")
 
@@ -1037,62 +1587,85 @@ if bot:  # Только если бот инициализирован
             return
         term_to_add = state.get("term")
         if user_input.lower() in ["нет", "no", "/cancel", "отмена"]:
-            logger.info(f"User cancelled add definition for '{term_to_add}'.")
+            logger.info("User cancelled add definition for '%s'.", term_to_add)
             return bot.send_message(chat_id, "Определение не добавлено.")
         if not term_to_add:
             logger.error("Term to add was lost from state.")
             return bot.send_message(chat_id, "Ошибка, термин потерян.")
         new_definition = user_input
         logger.info(
-            f"User {chat_id} adding definition for '{term_to_add}': '{new_definition}'"
+            "User %s adding definition for '%s': '%s'",
+            chat_id,
+            term_to_add,
+            new_definition,
         )
         if not glossary_sheet:
             return bot.send_message(chat_id, "Ошибка: Лист 'Глоссарий' не подключен.")
         try:
-            glossary_sheet.append_row(
-                [term_to_add, new_definition], value_input_option="USER_ENTERED"
-            )
-            logger.info(f"Successfully added '{term_to_add}' to glossary.")
+            append_glossary_row(term_to_add, new_definition)
+            logger.info("Successfully added '%s' to glossary.", term_to_add)
             bot.send_message(
                 chat_id, f"Термин '{term_to_add}' и его определение успешно добавлены!"
             )
         except Exception as e:
-            logger.error(f"Error appending to glossary sheet: {e}", exc_info=True)
+            logger.error("Error appending to glossary sheet: %s", e, exc_info=True)
             bot.send_message(chat_id, "Ошибка при добавлении.")
 
     # --- КОНЕЦ ОБРАБОТЧИКОВ ГЛОССАРИЯ ---
 
+    # --- Кнопки меню: один обработчик и поиск по словарю вместо лямбды на каждую кнопку ---
+    TEXT_ROUTES = {
+        "Скрыть меню": hide_menu,
+        "Добавить вручную (/add)": kb_add_manual_prompt,
+        "Добавить по ID Транз. (/fetch)": kb_addid,
+        "Закрыть сделку": kb_close_trade_prompt,
+        "Отчёт": handle_report,
+        "Обновить Скринер": handle_screener_update,
+        "Глоссарий": kb_glossary_start,
+    }
+
+    @bot.message_handler(func=lambda message: message.text in TEXT_ROUTES)
+    def handle_menu_button(message):
+        TEXT_ROUTES[message.text](message)
+
 else:  # Если bot is None
     logger.error(
         "CRITICAL: Bot object is None, Telegram command handlers cannot be registered!"
     )
 
 # === Webhook-роут ===
-if app and TOKEN:
+# Без бота роут не регистрируется, поэтому внутри проверять bot не нужно
+if app and bot:
 
     @app.route(f"/{TOKEN}", methods=["POST"])
     def webhook():
-        # ... (Код функции webhook без изменений) ...
-        logger.info("Webhook received!")
-        if not bot:
-            logger.error("Webhook received but bot is not initialized!")
-            return "error", 500
+        """Принимает обновления от Telegram и передает их в пул обработчиков бота."""
+        logger.debug("Webhook received!")
+        # Чужие запросы отсекаем по заголовку, не разбирая тело
+        # Сравниваем bytes: compare_digest на str с не-ASCII символами бросает TypeError
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+            WEBHOOK_SECRET.encode(),
+        ):
+            logger.warning("Webhook request with wrong secret token rejected.")
+            return "forbidden", 403
         try:
-            json_str = request.get_data().decode("UTF-8")
-            update = telebot.types.Update.de_json(json_str)
+            # orjson разбирает сырые bytes, de_json принимает готовый dict
+            update = telebot.types.Update.de_json(
+                orjson.loads(request.get_data(cache=False))
+            )
             bot.process_new_updates([update])
         except Exception as e:
-            logger.error(f"Error in webhook processing: {e}", exc_info=True)
+            logger.error("Error in webhook processing: %s", e, exc_info=True)
         return "ok", 200
 
 else:
     logger.error(
-        "CRITICAL: Flask app or TOKEN not defined, webhook route cannot be registered!"
+        "CRITICAL: Flask app or bot not initialized, webhook route cannot be registered!"
     )
 
 # === Запуск Flask-сервера ===
 if __name__ == "__main__":
-    # ... (Код блока __main__ без изменений) ...
     logger.info(
         "Attempting to run Flask development server (should only happen locally)"
     )
@@ -69,6 +69,8 @@ COL_IDX = {
     "bybit_exec_id": 28,  # AC: Bybit ID (для проверки дубликатов)
 }
 EXPECTED_COLUMNS = 29  # A-AC
+# Дата входа, если Bybit не прислал createdTime (столбец A не оставляем пустым)
+MISSING_ENTRY_DATE = "н/д"
 
 # --- Bybit ---
 BYBIT_ENV = os.getenv("BYBIT_ENV", "LIVE").upper()  # LIVE или TESTNET
@@ -362,7 +364,8 @@ def parse_and_prepare_sheet_data(pnl_records, existing_ids):
             continue
 
         logger.info(f"Processing new record with ID: {unique_id}")
-        row_data = [""] * EXPECTED_COLUMNS
+        # None = не трогать ячейку (формулы и ручные заметки в таблице сохраняются)
+        row_data = [None] * EXPECTED_COLUMNS
 
         try:
             # Время выхода (из updatedTime)
@@ -381,6 +384,12 @@ def parse_and_prepare_sheet_data(pnl_records, existing_ids):
                 entry_dt = datetime.datetime.fromtimestamp(entry_ts_ms / 1000)
                 row_data[COL_IDX["entry_date"]] = entry_dt.strftime("%d.%m.%Y")  # A
                 row_data[COL_IDX["entry_time"]] = entry_dt.strftime("%H.%M.%S")  # B
+            else:
+                # Столбец A не должен оставаться пустым: по нему ищется конец данных
+                logger.warning(
+                    f"Record {unique_id} has no 'createdTime', entry date set to '{MISSING_ENTRY_DATE}'."
+                )
+                row_data[COL_IDX["entry_date"]] = MISSING_ENTRY_DATE  # A
 
             row_data[COL_IDX["pair"]] = symbol  # E
             side = record.get("side", "").capitalize()
@@ -421,92 +430,42 @@ def parse_and_prepare_sheet_data(pnl_records, existing_ids):
     return rows_to_add
 
 
+def find_next_empty_row(sheet_instance):
+    """Номер строки после последней заполненной ячейки столбца A.
+
+    values.append здесь не подходит: он пишет после первого непрерывного блока в A,
+    и при пропуске (строку удалили вручную) затер бы сделки ниже него.
+    """
+    col_a = sheet_instance.col_values(1, value_render_option="UNFORMATTED_VALUE")
+    last = len(col_a)
+    while last and str(col_a[last - 1]).strip() == "":
+        last -= 1
+    return last + 1
+
+
 def add_data_to_sheet(sheet_instance, data_rows):
-    """Добавляет подготовленные строки данных в таблицу через batch_update."""
+    """Дописывает подготовленные строки после последней заполненной ячейки столбца A одним запросом."""
     if not data_rows:
         logger.info("No new data rows to add to the sheet.")
         return 0
 
     logger.info(f"Adding {len(data_rows)} rows to Google Sheet...")
     try:
-        logger.debug("Fetching column A values to find next empty row...")
-        col_a_values = sheet_instance.col_values(
-            1, value_render_option="UNFORMATTED_VALUE"
+        first_row = find_next_empty_row(sheet_instance)
+        last_row = first_row + len(data_rows) - 1
+        last_col = gspread.utils.rowcol_to_a1(1, EXPECTED_COLUMNS)[:-1]
+        target_range = f"A{first_row}:{last_col}{last_row}"
+        # Все строки за один запрос. Ячейки со значением None пропускаются,
+        # поэтому расчетные столбцы (K-R, U-AB) не затираются.
+        sheet_instance.spreadsheet.values_update(
+            gspread.utils.absolute_range_name(sheet_instance.title, target_range),
+            params={"valueInputOption": "USER_ENTERED"},
+            body={"values": data_rows},
         )
-        logger.debug(f"Found {len(col_a_values)} values in column A.")
-        last_data_row_index = len(col_a_values) - 1
-        while (
-            last_data_row_index > 0
-            and str(col_a_values[last_data_row_index]).strip() == ""
-        ):
-            last_data_row_index -= 1
-        target_row_number = last_data_row_index + 2
-        logger.info(f"Target starting row for update is {target_row_number}.")
-
-        updates = []
-        current_row = target_row_number
-        for row_data in data_rows:
-            # Обновляем только те ячейки, для которых у нас есть данные из API
-            # A, B, C, D, E, F, G, J, S, T, AC
-            cell_updates = [
-                {
-                    "range": f"A{current_row}",
-                    "values": [[row_data[COL_IDX["entry_date"]]]],
-                },
-                {
-                    "range": f"B{current_row}",
-                    "values": [[row_data[COL_IDX["entry_time"]]]],
-                },
-                {
-                    "range": f"C{current_row}",
-                    "values": [[row_data[COL_IDX["exit_date"]]]],
-                },
-                {
-                    "range": f"D{current_row}",
-                    "values": [[row_data[COL_IDX["exit_time"]]]],
-                },
-                {"range": f"E{current_row}", "values": [[row_data[COL_IDX["pair"]]]]},
-                {"range": f"F{current_row}", "values": [[row_data[COL_IDX["type"]]]]},
-                {
-                    "range": f"G{current_row}",
-                    "values": [[row_data[COL_IDX["entry_price"]]]],
-                },
-                # H, I (SL/TP) - Пропускаем
-                {
-                    "range": f"J{current_row}",
-                    "values": [[row_data[COL_IDX["volume_coins"]]]],
-                },
-                # K-R - Пропускаем (расчетные/комиссии)
-                {
-                    "range": f"S{current_row}",
-                    "values": [[row_data[COL_IDX["exit_method"]]]],
-                },  # Способ выхода (тип ордера Bybit)
-                {
-                    "range": f"T{current_row}",
-                    "values": [[row_data[COL_IDX["exit_price_actual"]]]],
-                },  # Факт. цена выхода
-                # U-AB - Пропускаем (расчетные/текст)
-                {
-                    "range": f"AC{current_row}",
-                    "values": [[row_data[COL_IDX["bybit_exec_id"]]]],
-                },  # Записываем ID Bybit
-            ]
-            # Фильтруем обновления, где значение None (на всякий случай)
-            updates.extend(
-                [upd for upd in cell_updates if upd["values"][0][0] is not None]
-            )
-            current_row += 1
-
-        if updates:
-            logger.debug(f"Executing batch update for {len(data_rows)} rows.")
-            sheet_instance.batch_update(updates, value_input_option="USER_ENTERED")
-            logger.info(
-                f"Successfully added/updated {len(data_rows)} rows in the sheet."
-            )
-            return len(data_rows)
-        else:
-            logger.info("No updates to execute.")
-            return 0
+        logger.info(
+            f"Successfully added {len(data_rows)} rows in the sheet ({target_range})."
+        )
+        return len(data_rows)
 
     except Exception as e:
         logger.error(f"Error adding data to sheet: {e}", exc_info=True)
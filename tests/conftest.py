@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.py настраивается при импорте: нужен токен, а Sheets/webhook не подключаем
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST_TOKEN")
+os.environ.pop("TELEGRAM_WEBHOOK_URL", None)
+os.environ.pop("SPREADSHEET_ID", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,12 @@
+from pybit.unified_trading import HTTP
+
+import app
+
+
+def test_cached_signature_matches_pybit():
+    cached = app.CachedSignatureHTTP(api_key="k", api_secret="s")
+    plain = HTTP(api_key="k", api_secret="s")
+    for payload, timestamp in (("category=linear", 1700000000000), ("", 1700000000001)):
+        assert cached._auth(payload, 5000, timestamp) == plain._auth(
+            payload, 5000, timestamp
+        )
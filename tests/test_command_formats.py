@@ -0,0 +1,84 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "/add SOL/USDT Лонг 139.19 141.8 136.9 1.5 OID-1",
+        "/add BTCUSDT шорт 1 2 3 4 x",
+        "/add@kapitalyuga_bot ETHUSDT ЛОНГ 1.0 2.0 0.5 3 abc  ",
+    ],
+)
+def test_add_accepts(text):
+    assert app._ADD_RE.match(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "/add SOLUSDT Лонг 1 2 3 4",  # нет Order ID
+        "/add SOLUSDT Long 1 2 3 4 OID",
+        "/add SOLUSDT Лонг 1 2 -3 4 OID",
+        "/add SOLUSDT Лонг 1 2 3 4 OID extra",
+        "/addition SOLUSDT Лонг 1 2 3 4 OID",
+    ],
+)
+def test_add_rejects(text):
+    assert not app._ADD_RE.match(text)
+
+
+def test_add_groups():
+    m = app._ADD_RE.match("/add SOL/USDT Лонг 139.19 141.8 136.9 1.5 OID-1")
+    assert m.group("asset", "dir", "entry", "tp", "sl", "qty", "oid") == (
+        "SOL/USDT",
+        "Лонг",
+        "139.19",
+        "141.8",
+        "136.9",
+        "1.5",
+        "OID-1",
+    )
+
+
+@pytest.mark.parametrize(
+    "text, asset, price",
+    [
+        ("/close SOL/USDT 140.55", "SOL/USDT", "140.55"),
+        ("/close@kapitalyuga_bot BTCUSDT 1 ", "BTCUSDT", "1"),
+    ],
+)
+def test_close_accepts(text, asset, price):
+    m = app._CLOSE_RE.match(text)
+    assert m.group("asset", "price") == (asset, price)
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["/close BTCUSDT", "/close BTCUSDT 1,5", "/close BTCUSDT 1 2", "/closeX A 1"],
+)
+def test_close_rejects(text):
+    assert not app._CLOSE_RE.match(text)
+
+
+@pytest.mark.parametrize(
+    "text, asset, price",
+    [
+        ("SOL/USDT 145.88", "SOL/USDT", "145.88"),
+        ("  BTCUSDT 1,5 ", "BTCUSDT", "1,5"),
+    ],
+)
+def test_close_input_accepts(text, asset, price):
+    assert app._CLOSE_INPUT_RE.match(text).group("asset", "price") == (asset, price)
+
+
+@pytest.mark.parametrize("text", ["BTCUSDT", "BTCUSDT abc", "BTCUSDT 1 2", ""])
+def test_close_input_rejects(text):
+    assert not app._CLOSE_INPUT_RE.match(text)
+
+
+def test_fetch():
+    assert app._FETCH_RE.match("/fetch abc-123 ")["exec_id"] == "abc-123"
+    assert not app._FETCH_RE.match("/fetch")
+    assert not app._FETCH_RE.match("/fetch a b")
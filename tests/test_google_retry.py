@@ -0,0 +1,68 @@
+from unittest import mock
+
+import gspread
+import pytest
+
+import app
+
+
+def api_error(status, retry_after=None):
+    response = mock.Mock(status_code=status, headers={})
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    response.json.return_value = {
+        "error": {"code": status, "message": "error", "status": "ERROR"}
+    }
+    return gspread.exceptions.APIError(response)
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    slept = []
+    monkeypatch.setattr(app.time, "sleep", slept.append)
+    monkeypatch.setattr(app.sheets_write_bucket, "acquire", lambda: None)
+    return slept
+
+
+def flaky(*errors, idempotent=True):
+    """Функция, которая по очереди бросает errors, а затем возвращает "ok"."""
+    fn = mock.Mock(side_effect=[*errors, "ok"], __name__="write")
+    return fn, app.google_retry(idempotent=idempotent)(fn)
+
+
+def test_429_is_retried_with_retry_after(delays):
+    fn, wrapped = flaky(api_error(429, "3"), idempotent=False)
+    assert wrapped() == "ok"
+    assert fn.call_count == 2
+    assert delays == [3.0]
+
+
+def test_5xx_is_retried_only_when_idempotent(delays):
+    fn, wrapped = flaky(api_error(503))
+    assert wrapped() == "ok"
+    assert fn.call_count == 2
+
+    fn, wrapped = flaky(api_error(503), idempotent=False)
+    with pytest.raises(gspread.exceptions.APIError):
+        wrapped()
+    assert fn.call_count == 1
+
+
+def test_client_error_is_not_retried(delays):
+    fn, wrapped = flaky(api_error(400))
+    with pytest.raises(gspread.exceptions.APIError):
+        wrapped()
+    assert fn.call_count == 1
+    assert delays == []
+
+
+def test_exponential_backoff_and_give_up(delays):
+    errors = [api_error(429) for _ in range(app.GOOGLE_RETRY_ATTEMPTS)]
+    fn, wrapped = flaky(*errors)
+    with pytest.raises(gspread.exceptions.APIError):
+        wrapped()
+    assert fn.call_count == app.GOOGLE_RETRY_ATTEMPTS
+    base = app.GOOGLE_RETRY_BASE_DELAY
+    assert len(delays) == app.GOOGLE_RETRY_ATTEMPTS - 1
+    for attempt, delay in enumerate(delays):
+        assert base * 2**attempt <= delay <= base * 2**attempt + base
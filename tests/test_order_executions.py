@@ -0,0 +1,76 @@
+from unittest import mock
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def bybit(monkeypatch):
+    session = mock.Mock()
+    monkeypatch.setattr(app, "bybit_session", session)
+    return session
+
+
+def page(executions, cursor=""):
+    return {"retCode": 0, "result": {"list": executions, "nextPageCursor": cursor}}
+
+
+def test_load_order_executions_follows_cursor(bybit):
+    bybit.get_executions.side_effect = [
+        page([{"execId": "1"}], "c2"),
+        page([{"execId": "2"}]),
+    ]
+    assert app.load_order_executions("O1") == [{"execId": "1"}, {"execId": "2"}]
+    first, second = bybit.get_executions.call_args_list
+    assert "cursor" not in first.kwargs
+    assert second.kwargs["cursor"] == "c2"
+    assert second.kwargs["orderId"] == "O1"
+
+
+def test_load_order_executions_raises_on_api_error(bybit):
+    bybit.get_executions.return_value = {"retCode": 10002, "retMsg": "error"}
+    with pytest.raises(RuntimeError):
+        app.load_order_executions("O1")
+
+
+@pytest.fixture
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(app, "order_exec_cache", {})
+
+
+def test_filled_order_is_cached(monkeypatch, empty_cache):
+    load = mock.Mock(return_value=[{"leavesQty": "1"}, {"leavesQty": "0"}])
+    monkeypatch.setattr(app, "load_order_executions", load)
+    first = app.fetch_order_executions("O1")
+    assert app.fetch_order_executions("O1") == first
+    load.assert_called_once_with("O1")
+
+
+def test_partially_filled_order_is_not_cached(monkeypatch, empty_cache):
+    load = mock.Mock(return_value=[{"leavesQty": "1"}, {"leavesQty": ""}])
+    monkeypatch.setattr(app, "load_order_executions", load)
+    app.fetch_order_executions("O1")
+    app.fetch_order_executions("O1")
+    assert load.call_count == 2
+
+
+def test_cache_entry_expires(monkeypatch, empty_cache):
+    load = mock.Mock(return_value=[{"leavesQty": "0"}])
+    monkeypatch.setattr(app, "load_order_executions", load)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    app.fetch_order_executions("O1")
+    now[0] += app.ORDER_EXEC_CACHE_TTL + 1
+    app.fetch_order_executions("O1")
+    assert load.call_count == 2
+
+
+def test_cache_is_bounded(monkeypatch, empty_cache):
+    monkeypatch.setattr(app, "ORDER_EXEC_CACHE_SIZE", 2)
+    monkeypatch.setattr(
+        app, "load_order_executions", lambda order_id: [{"leavesQty": "0"}]
+    )
+    for order_id in ("O1", "O2", "O3"):
+        app.fetch_order_executions(order_id)
+    assert list(app.order_exec_cache) == ["O2", "O3"]
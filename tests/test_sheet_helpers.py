@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def fake_sheet(monkeypatch):
+    sheet = mock.Mock(title="Таблица сделок")
+    monkeypatch.setattr(app, "sheet", sheet)
+    monkeypatch.setattr(app.sheets_read_bucket, "acquire", lambda: None)
+    return sheet
+
+
+def test_build_cell_updates_merges_adjacent_columns():
+    updates = app.build_cell_updates(
+        7,
+        exit_price_actual=101.5,
+        exit_date="01.02.2026",
+        exit_method="вручную",
+        exit_time="10:00:00",
+    )
+    assert updates == [
+        {"range": "C7:D7", "values": [["01.02.2026", "10:00:00"]]},
+        {"range": "S7:T7", "values": [["вручную", 101.5]]},
+    ]
+
+
+def test_build_cell_updates_single_cell():
+    assert app.build_cell_updates(3, entry_order_id="OID") == [
+        {"range": "AD3", "values": [["OID"]]}
+    ]
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("=IMPORTXML(A1)", "'=IMPORTXML(A1)"),
+        ("+7", "'+7"),
+        ("-A1", "'-A1"),
+        ("@me", "'@me"),
+        ("BTCUSDT", "BTCUSDT"),
+        ("01.02.2026", "01.02.2026"),
+        (1.5, 1.5),
+        (None, None),
+    ],
+)
+def test_sheet_text(value, expected):
+    assert app.sheet_text(value) == expected
+
+
+def test_build_trade_row_places_values_and_escapes_text():
+    row = app.build_trade_row(pair="=X", entry_price=2.0)
+    assert len(row) == app.EXPECTED_COLUMNS
+    assert row[app.COL_IDX["pair"]] == "'=X"
+    assert row[app.COL_IDX["entry_price"]] == 2.0
+    assert row.count(None) == app.EXPECTED_COLUMNS - 2
+
+
+def test_find_open_trade_row_takes_lowest_open_match(fake_sheet):
+    # Строки 2..6: BTC открыта в 2 и 5, закрыта в 3
+    fake_sheet.batch_get.return_value = [
+        [["BTCUSDT", "btcusdt", "SOLUSDT", "BTCUSDT", "ETHUSDT"]],
+        [["", 100, "", "", 105]],
+    ]
+    assert app.find_open_trade_row("BtcUsdt") == 5
+    fake_sheet.batch_get.assert_called_once_with(
+        ["E2:E", "T2:T"],
+        major_dimension="COLUMNS",
+        value_render_option="UNFORMATTED_VALUE",
+    )
+
+
+def test_find_open_trade_row_trailing_rows_without_exit(fake_sheet):
+    # Столбец T обрезан API после последней заполненной ячейки
+    fake_sheet.batch_get.return_value = [[["SOLUSDT", "SOLUSDT"]], [[1.0]]]
+    assert app.find_open_trade_row("SOLUSDT") == 3
+
+
+def test_find_open_trade_row_no_match(fake_sheet):
+    fake_sheet.batch_get.return_value = [[["SOLUSDT"]], [[1.0]]]
+    assert app.find_open_trade_row("SOLUSDT") is None
+    fake_sheet.batch_get.return_value = [[], []]
+    assert app.find_open_trade_row("SOLUSDT") is None
+
+
+def test_next_trade_row_skips_gaps_in_column_a(fake_sheet):
+    fake_sheet.col_values.return_value = ["Дата", "01.01", "", "03.01", " "]
+    assert app.next_trade_row() == 5
+
+
+@pytest.mark.parametrize("header, expected", [("7", 7.0), ("", None), ("soon", None)])
+def test_retry_after_seconds(header, expected):
+    error = SimpleNamespace(response=SimpleNamespace(headers={"Retry-After": header}))
+    assert app.retry_after_seconds(error) == expected
@@ -0,0 +1,138 @@
+import queue
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def notified(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "notify_user", lambda message, text: sent.append(text))
+    return sent
+
+
+@pytest.fixture
+def write_queue(monkeypatch):
+    # Отдельная очередь, чтобы записи не забрал фоновый поток записи
+    q = queue.Queue()
+    monkeypatch.setattr(app, "sheet_write_queue", q)
+    return q
+
+
+def drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get_nowait())
+    return items
+
+
+def test_retry_or_drop_requeues_until_max_attempts(write_queue, notified, monkeypatch):
+    monkeypatch.setattr(app, "claimed_close_rows", {5})
+    fresh = {"message": None, "row": [], "attempts": 0}
+    last = {
+        "message": None,
+        "asset": "BTCUSDT",
+        "row_number": 5,
+        "attempts": app.SHEET_WRITE_MAX_ATTEMPTS - 1,
+    }
+    app.retry_or_drop([fresh, last])
+    assert drain(write_queue) == [fresh]
+    assert fresh["attempts"] == 1
+    assert notified == ["Ошибка: не удалось записать сделку в таблицу."]
+    assert app.claimed_close_rows == set()
+
+
+def test_writer_caps_batch_size(monkeypatch):
+    batches = []
+    monkeypatch.setattr(app, "SHEET_WRITE_MAX_BATCH", 3)
+    monkeypatch.setattr(
+        app, "write_queued_rows", lambda items: batches.append(len(items)) or True
+    )
+    for i in range(5):
+        app.sheet_write_queue.put({"row": [i]})
+    deadline = time.monotonic() + 3
+    while sum(batches) < 5 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert batches == [3, 2]
+
+
+def test_recorded_orders_are_skipped(monkeypatch, notified):
+    monkeypatch.setattr(app, "recorded_order_ids", lambda: {"O-OLD"})
+    items = [
+        {"message": None, "order_id": "O-OLD"},
+        {"message": None, "order_id": "O1"},
+        {"message": None, "order_id": "O1"},
+        {"message": None, "order_id": None},
+    ]
+    assert app.skip_recorded_orders(items) == [items[1], items[3]]
+    assert len(notified) == 2
+
+
+def test_skip_recorded_orders_without_order_ids_reads_nothing(monkeypatch):
+    monkeypatch.setattr(app, "recorded_order_ids", lambda: pytest.fail("read"))
+    items = [{"message": None, "order_id": None}]
+    assert app.skip_recorded_orders(items) == items
+
+
+@pytest.fixture
+def close_sheet(monkeypatch):
+    sheet = SimpleNamespace(title="T")
+    monkeypatch.setattr(app, "sheet", sheet)
+    monkeypatch.setattr(app, "claimed_close_rows", set())
+    # Строки 2..4: BTC, BTC, SOL - все открыты
+    reads = []
+    monkeypatch.setattr(
+        app,
+        "read_trade_columns",
+        lambda: reads.append(1) or (["BTCUSDT", "BTCUSDT", "SOLUSDT"], []),
+    )
+    written = []
+    monkeypatch.setattr(app, "batch_update_ranges", written.append)
+    return SimpleNamespace(reads=reads, written=written)
+
+
+def close_item(asset, price):
+    return {
+        "message": None,
+        "asset": asset,
+        "values": {"exit_price_actual": price},
+        "reply": f"closed {price}",
+        "attempts": 0,
+    }
+
+
+def test_queued_closes_of_one_pair_take_different_rows(close_sheet, notified):
+    items = [
+        close_item("BTCUSDT", 1),
+        close_item("btcusdt", 2),
+        close_item("BTCUSDT", 3),
+    ]
+    assert app.write_queued_closes(items)
+    ranges = [d["range"] for data in close_sheet.written for d in data]
+    assert ranges == ["'T'!T3", "'T'!T2"]
+    assert notified == [
+        "Не найдена ОТКРЫТАЯ сделка по BTCUSDT.",
+        "closed 1",
+        "closed 2",
+    ]
+    assert app.claimed_close_rows == set()
+
+
+def test_failed_close_keeps_its_row_for_retry(close_sheet, notified, write_queue):
+    def fail(data):
+        raise RuntimeError("boom")
+
+    app.batch_update_ranges = fail
+    assert not app.write_queued_closes([close_item("SOLUSDT", 5)])
+    (retry,) = drain(write_queue)
+    assert retry["row_number"] == 4
+    assert app.claimed_close_rows == {4}
+
+    close_sheet.written.clear()
+    app.batch_update_ranges = close_sheet.written.append
+    assert app.write_queued_closes([retry])
+    assert close_sheet.reads == [1]  # повтор не перечитывает столбцы
+    assert [d["range"] for d in close_sheet.written[0]] == ["'T'!T4"]
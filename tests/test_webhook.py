@@ -0,0 +1,47 @@
+from unittest import mock
+
+import pytest
+
+import app
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "x"},
+        "text": "/start",
+    },
+}
+
+
+@pytest.fixture
+def process(monkeypatch):
+    monkeypatch.setattr(app, "WEBHOOK_SECRET", "s3")
+    process = mock.Mock()
+    monkeypatch.setattr(app.bot, "process_new_updates", process)
+    return process
+
+
+def post(headers):
+    return app.app.test_client().post(f"/{app.TOKEN}", json=UPDATE, headers=headers)
+
+
+@pytest.mark.parametrize(
+    "headers",
+    [
+        {},
+        {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+        {"X-Telegram-Bot-Api-Secret-Token": "sé"},
+    ],
+)
+def test_webhook_rejects_bad_secret(process, headers):
+    assert post(headers).status_code == 403
+    process.assert_not_called()
+
+
+def test_webhook_accepts_secret(process):
+    assert post({"X-Telegram-Bot-Api-Secret-Token": "s3"}).status_code == 200
+    (updates,), _ = process.call_args
+    assert updates[0].update_id == 1